@@ -38,10 +38,26 @@ DEBUG_DB = False
 DB = "mongodb:///ivre"
 DB_DATA = None  # specific: maxmind:///<ivre_share_path>/geoip
 # Begin batch sizes
-LOCAL_BATCH_SIZE = 10000      # used with --local-bulk
+# used with --local-bulk: maximum number of (aggregated) records kept
+# in memory, before they are written to a temporary file
+LOCAL_BATCH_SIZE = 10000
+# used with --local-bulk: maximum number of temporary files, before
+# they are merged and the records are inserted
+LOCAL_BATCH_RUNS = 10
 MONGODB_BATCH_SIZE = 100
+MONGODB_HOSTS_BATCH_SIZE = 1000  # used when storing scan results
+# used when storing flows: maximum number of (aggregated) flows kept
+# in memory, and maximum time (in seconds) they are kept, before they
+# are written to the database
+MONGODB_FLOW_BATCH_SIZE = 10000
+MONGODB_FLOW_BATCH_TIMEOUT = 60
 NEO4J_BATCH_SIZE = 1000
 POSTGRES_BATCH_SIZE = 10000
+# used by SqliteDBPassive bulk inserts: number of records per transaction
+SQLITE_BATCH_SIZE = 10000
+# used by TinyDBPassive bulk inserts: maximum number of pending
+# records before the database file is written
+TINYDB_BATCH_SIZE = 10000
 # End batch sizes
 # specific: if no value is specified for *_PATH variables, they are
 # going to be constructed by guessing the installation PREFIX (see the
@@ -173,6 +189,17 @@ MAXMIND_LICENSE_KEY = None
 # End IPDATA_URLS
 
 GEOIP_LANG = "en"
+# Number of results cached (in memory) by ivre.passive.getinfos() (0
+# to disable); when set, PASSIVE_GETINFOS_CACHE_PATH is the path of a
+# (shelve) file where the results are also stored, to be reused by
+# the next processes
+PASSIVE_GETINFOS_CACHE_SIZE = 65536
+PASSIVE_GETINFOS_CACHE_PATH = None
+# Number of entries (network prefixes) cached by db.data.infos_byip()
+GEOIP_CACHE_SIZE = 65536
+# Number of decoded records cached for each MaxMind database file (None
+# for no limit, 0 to disable)
+GEOIP_RECORDS_CACHE_SIZE = 100000
 
 WEB_ALLOWED_REFERERS = None
 WEB_NOTES_BASE = "/dokuwiki/#IP#"
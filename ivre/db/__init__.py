@@ -28,7 +28,8 @@ except ImportError:
     OrderedDict = dict
 from datetime import datetime, timedelta
 from functools import reduce
-from itertools import chain
+import heapq
+from itertools import chain, groupby
 import json
 import os
 import pickle
@@ -88,6 +89,8 @@ class DB(object):
     ipaddr_fields = []
     datetime_fields = []
     list_fields = []
+    # Can several processes write to the database at the same time?
+    concurrent_writes = True
 
     def __init__(self):
         self.argparser = utils.ArgparserParent()
@@ -1629,12 +1632,19 @@ class DBNmap(DBActive):
         if self.output_function is not None:
             self.output_function(host, out=self.output)
 
-    def store_scan(self, fname, **kargs):
+    def store_scan(self, fname, filehash=None, **kargs):
         """This method opens a scan result, and calls the appropriate
         store_scan_* method to parse (and store) the scan result.
 
+        When `filehash` is provided, it is used as the scan ID instead
+        of computing the SHA-256 hash of the file (this is useful when
+        the hash has already been computed, e.g., by another process).
+
         """
-        scanid = utils.hash_file(fname, hashtype="sha256")
+        if filehash is None:
+            scanid = utils.hash_file(fname, hashtype="sha256")
+        else:
+            scanid = filehash
         if self.is_scan_present(scanid):
             utils.LOGGER.debug("Scan already present in Database (%r).", fname)
             return False
@@ -1666,7 +1676,14 @@ class DBNmap(DBActive):
                     raise ValueError("Unknown file type %s" % fname)
             else:
                 raise ValueError("Unknown file type %s" % fname)
-        return store_scan_function(fname, filehash=scanid, **kargs)
+        try:
+            return store_scan_function(fname, filehash=scanid, **kargs)
+        except Exception:
+            # Some backends buffer the hosts between
+            # .start_store_hosts() and .stop_store_hosts(): make sure
+            # the hosts parsed before the error get stored.
+            self.stop_store_hosts()
+            raise
 
     def store_scan_xml(self, fname, callback=None, **kargs):
         """This method parses an XML scan result, displays a JSON
@@ -1741,11 +1758,9 @@ class DBNmap(DBActive):
                 if add_addr_infos and self.globaldb is not None and (
                         force_info or 'infos' not in host or not host['infos']
                 ):
-                    host['infos'] = {}
-                    for func in [self.globaldb.data.country_byip,
-                                 self.globaldb.data.as_byip,
-                                 self.globaldb.data.location_byip]:
-                        host['infos'].update(func(host['addr']) or {})
+                    host['infos'] = self.globaldb.data.infos_byip(
+                        host['addr'], addr_type=False,
+                    ) or {}
                 # Update schema if/as needed.
                 while host.get(
                         "schema_version"
@@ -1874,11 +1889,9 @@ class DBNmap(DBActive):
                 if add_addr_infos and self.globaldb is not None and (
                         force_info or 'infos' not in host or not host['infos']
                 ):
-                    host['infos'] = {}
-                    for func in [self.globaldb.data.country_byip,
-                                 self.globaldb.data.as_byip,
-                                 self.globaldb.data.location_byip]:
-                        host['infos'].update(func(host['addr']) or {})
+                    host['infos'] = self.globaldb.data.infos_byip(
+                        host['addr'], addr_type=False,
+                    ) or {}
                 # We are about to insert data based on this file,
                 # so we want to save the scan document
                 if not scan_doc_saved:
@@ -1950,11 +1963,9 @@ class DBNmap(DBActive):
                 if add_addr_infos and self.globaldb is not None and (
                         force_info or 'infos' not in host or not host['infos']
                 ):
-                    host['infos'] = {}
-                    for func in [self.globaldb.data.country_byip,
-                                 self.globaldb.data.as_byip,
-                                 self.globaldb.data.location_byip]:
-                        host['infos'].update(func(host['addr']) or {})
+                    host['infos'] = self.globaldb.data.infos_byip(
+                        host['addr'], addr_type=False,
+                    ) or {}
                 # We are about to insert data based on this file,
                 # so we want to save the scan document
                 if not scan_doc_saved:
@@ -2324,7 +2335,7 @@ class _RecInfo(object):
             if self.lastseen is None:
                 self.lastseen = lastseen
             else:
-                self.lastseen = min(self.lastseen, lastseen)
+                self.lastseen = max(self.lastseen, lastseen)
 
     def update(self, timestamp):
         self.count += 1
@@ -2471,36 +2482,44 @@ class DBPassive(DB):
     def insert_or_update_local_bulk(self, specs, getinfos=None,
                                     separated_timestamps=True):
         """Like `.insert_or_update()`, but `specs` parameter has to be an
-        iterable of (timestamp, spec) values. This generic
-        implementation does not use the bulk capacity of the
-        underlying DB implementation but uses a local cache and calls
-        its `.insert_or_update()` method.
+        iterable of (timestamp, spec) values. The specs are aggregated
+        locally (the specs that only differ by their "count",
+        "firstseen" and "lastseen" values are merged), and the
+        aggregated records are then inserted using the
+        `.insert_or_update_bulk()` method of the underlying DB
+        implementation.
+
+        At most `config.LOCAL_BATCH_SIZE` records are kept in memory:
+        when more records are found, they are written, sorted, to a
+        temporary file (a "run"), and the runs are merged (and
+        aggregated again) at the end, or as soon as there are
+        `config.LOCAL_BATCH_RUNS` runs, so that the records from a
+        stream that does not end are inserted regularly.
 
         """
-        def _bulk_execute(records):
-            utils.LOGGER.debug("DB:local bulk upsert: %d", len(records))
-            for spec, metadata in viewitems(records):
-                self.insert_or_update(metadata.firstseen,
-                                      dict(spec, **metadata.data),
-                                      getinfos=getinfos,
-                                      lastseen=metadata.lastseen)
         records = {}
-        utils.LOGGER.debug("DB: creating a local bulk upsert (%d records)",
-                           config.LOCAL_BATCH_SIZE)
+        runs = []
+        count = 0
         if separated_timestamps:
             for timestamp, spec in specs:
                 if spec is None:
                     continue
+                count += 1
                 infos = spec.pop('infos', None)
                 spec = tuple((key, spec[key]) for key in sorted(spec))
                 records.setdefault(spec, _RecInfo(infos)).update(timestamp)
                 if len(records) >= config.LOCAL_BATCH_SIZE:
-                    _bulk_execute(records)
+                    runs.append(self._local_bulk_spill(records))
                     records = {}
+                    if len(runs) >= config.LOCAL_BATCH_RUNS:
+                        self._local_bulk_write({}, runs, count, getinfos)
+                        runs = []
+                        count = 0
         else:
             for spec in specs:
                 if spec is None:
                     continue
+                count += 1
                 infos = spec.pop('infos', None)
                 basespec = tuple(
                     (key, spec[key]) for key in sorted(spec)
@@ -2509,9 +2528,105 @@ class DBPassive(DB):
                 records.setdefault(basespec,
                                    _RecInfo(infos)).update_from_spec(spec)
                 if len(records) >= config.LOCAL_BATCH_SIZE:
-                    _bulk_execute(records)
+                    runs.append(self._local_bulk_spill(records))
                     records = {}
-        _bulk_execute(records)
+                    if len(runs) >= config.LOCAL_BATCH_RUNS:
+                        self._local_bulk_write({}, runs, count, getinfos)
+                        runs = []
+                        count = 0
+        self._local_bulk_write(records, runs, count, getinfos)
+
+    def _local_bulk_write(self, records, runs, count, getinfos):
+        """Merges the records in memory and the records from the runs
+        (see `._local_bulk_merge()`), and inserts them using
+        `.insert_or_update_bulk()`.
+
+        """
+        self.insert_or_update_bulk(
+            self._local_bulk_merge(records, runs, count),
+            getinfos=getinfos,
+            separated_timestamps=False,
+        )
+
+    @staticmethod
+    def _local_bulk_sorted(records):
+        """Returns the records (from a {spec: _RecInfo} dict) as a sorted
+        list of (key, count, firstseen, lastseen, infos) tuples, where
+        key is the pickled spec.
+
+        """
+        return sorted(
+            ((pickle.dumps(spec, protocol=2), rec.count, rec.firstseen,
+              rec.lastseen, rec.infos)
+             for spec, rec in viewitems(records)),
+            key=lambda rec: rec[0],
+        )
+
+    def _local_bulk_spill(self, records):
+        """Writes the records (from a {spec: _RecInfo} dict), sorted, to a
+        temporary file and returns it.
+
+        """
+        utils.LOGGER.debug("DB:local bulk: writing %d records to disk",
+                           len(records))
+        fdesc = tempfile.TemporaryFile()
+        for rec in self._local_bulk_sorted(records):
+            pickle.dump(rec, fdesc, protocol=2)
+        fdesc.seek(0)
+        return fdesc
+
+    @staticmethod
+    def _local_bulk_read_run(fdesc, index):
+        """Yields (key, index, record) tuples from a run written by
+        `._local_bulk_spill()`, and closes it.
+
+        """
+        with fdesc:
+            while True:
+                try:
+                    rec = pickle.load(fdesc)
+                except EOFError:
+                    break
+                yield rec[0], index, rec
+
+    def _local_bulk_merge(self, records, runs, count):
+        """Merges the records in memory (from a {spec: _RecInfo} dict)
+        and the records from the runs, and yields the aggregated specs
+        (with their "count", "firstseen" and "lastseen" values).
+
+        """
+        # (key, stream index, record): the keys are unique within a
+        # stream, so the records are never compared
+        streams = [self._local_bulk_read_run(run, i)
+                   for i, run in enumerate(runs)]
+        streams.append((rec[0], len(runs), rec)
+                       for rec in self._local_bulk_sorted(records))
+        merged = 0
+        for key, group in groupby(heapq.merge(*streams),
+                                  key=lambda elt: elt[0]):
+            spec = dict(pickle.loads(key))
+            spec['count'] = 0
+            firstseen = lastseen = infos = None
+            for _, _, (_, rcount, rfirstseen, rlastseen, rinfos) in group:
+                spec['count'] += rcount
+                if rfirstseen is not None and (firstseen is None or
+                                               rfirstseen < firstseen):
+                    firstseen = rfirstseen
+                if rlastseen is not None and (lastseen is None or
+                                              rlastseen > lastseen):
+                    lastseen = rlastseen
+                if infos is None:
+                    infos = rinfos
+            if firstseen is not None:
+                spec['firstseen'] = firstseen
+            if lastseen is not None:
+                spec['lastseen'] = lastseen
+            if infos:
+                spec['infos'] = infos
+            merged += 1
+            yield spec
+        utils.LOGGER.debug("DB:local bulk upsert: %d specs aggregated as %d "
+                           "records (%d runs)", count, merged, len(runs))
 
     def _features_port_get(self, features, flt, yieldall, use_service,
                            use_product, use_version):
@@ -2660,11 +2775,17 @@ old element and delete the existing one."""
 class DBData(DB):
     country_codes = None
 
-    def infos_byip(self, addr):
+    def infos_byip(self, addr, addr_type=True):
+        """Returns all the available data for `addr` (the address type,
+unless `addr_type` is False, plus AS, country and location data), as a
+dict, or None when no data is available.
+
+        """
         infos = {}
-        addr_type = utils.get_addr_type(addr)
         if addr_type:
-            infos['address_type'] = addr_type
+            addr_type = utils.get_addr_type(addr)
+            if addr_type:
+                infos['address_type'] = addr_type
         for infos_byip in [self.as_byip,
                            self.country_byip,
                            self.location_byip]:
@@ -2673,6 +2794,13 @@ class DBData(DB):
             return infos
         return None
 
+    def infos_byip_many(self, addrs, addr_type=True):
+        """Same as [self.infos_byip(addr, addr_type=addr_type) for addr in
+addrs]. Backend-specific subclasses may implement a faster version.
+
+        """
+        return [self.infos_byip(addr, addr_type=addr_type) for addr in addrs]
+
     def as_byip(self, addr):
         raise NotImplementedError
 
@@ -22,21 +22,29 @@ files.
 """
 
 
+from array import array
+from bisect import bisect_right
 import codecs
 from functools import reduce
+import json
+import mmap
 import os
 import sys
 import struct
 
 
 from builtins import object, range
-from future.utils import viewitems
+from future.utils import PY3, viewitems
+from past.builtins import basestring
 
 
-from ivre import config, utils
+from ivre import config, geoiputils, utils
 from ivre.db import DBData
 
 
+UINT8 = struct.Struct('B')
+
+
 class MaxMindFileIter(object):
 
     """Iterator for MaxMindFile"""
@@ -77,13 +85,154 @@ class MaxMindFileIter(object):
                     self.nextval = None
                 else:
                     self.current.append(1)
-                return (curvalinf, curvalsup,
-                        self.base.decode(pos, self.base.data_section_start)[1])
+                return (curvalinf, curvalsup, self.base.decode_record(pos))
             node_no = next_node_no
         # We should never reach this point if the file is properly formatted.
         raise StopIteration()
 
 
+class MaxMindRangesIndex(object):
+
+    """Flat, sorted index of the IPv4 ranges of a MaxMind database,
+built by `MaxMindFile.write_ranges_index()`; lookups use a binary
+search on the ranges instead of walking the tree.
+
+The file is memory-mapped (and hence shared between processes) and
+contains, after a header (magic, number of ranges, number of
+records):
+
+  - the first address of each range (array of unsigned 32-bit
+    integers); the ranges are contiguous and cover the whole IPv4
+    address space.
+
+  - the record ID of each range (array of unsigned 32-bit integers).
+
+  - the offset of each record, plus the end offset of the last one
+    (array of unsigned 64-bit integers).
+
+  - the records, JSON-encoded; each distinct record is stored once.
+
+Integers are stored in the native byte order, which is part of the
+magic value. Values of type bytes are stored as {"$bytes": <base64>}
+objects, so that the records read from the index are the same as those
+read from the database.
+
+The index is only available with Python 3: with Python 2, the arrays
+would have to be copied from the file (memoryview.cast() does not
+exist) rather than shared, and the tree is used instead.
+
+    """
+
+    MAGIC = b'IVRERNG' + (b'<' if sys.byteorder == 'little' else b'>')
+    HEADER = struct.Struct('=8sQQ')
+    AVAILABLE = PY3 and utils.ARRAY_UINT64 is not None
+
+    def __init__(self, path):
+        if not self.AVAILABLE:
+            raise ValueError('Cannot use ranges index %r with this Python '
+                             'version' % path)
+        self.path = path
+        with open(path, 'rb') as fdesc:
+            self.data = mmap.mmap(fdesc.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, rec_count = self.HEADER.unpack_from(self.data, 0)
+        if magic != self.MAGIC:
+            raise ValueError('Invalid ranges index file %r' % path)
+        pos = self.HEADER.size
+        self.starts = self._array('I', pos, count)
+        pos += self.starts.itemsize * count
+        self.record_ids = self._array('I', pos, count)
+        pos += self.record_ids.itemsize * count
+        self.record_offsets = self._array(utils.ARRAY_UINT64, pos,
+                                          rec_count + 1)
+        pos += self.record_offsets.itemsize * (rec_count + 1)
+        self.records_start = pos
+        self.records_cache_size = config.GEOIP_RECORDS_CACHE_SIZE
+        self._records_cache = utils.OrderedDict()
+
+    def _array(self, typecode, pos, count):
+        size = array(typecode).itemsize * count
+        return memoryview(self.data)[pos:pos + size].cast(typecode)
+
+    @staticmethod
+    def _json_default(obj):
+        if isinstance(obj, bytes):
+            return {'$bytes': utils.encode_b64(obj).decode()}
+        return utils.serialize(obj)
+
+    @staticmethod
+    def _json_object_hook(obj):
+        if len(obj) == 1 and '$bytes' in obj:
+            return utils.decode_b64(obj['$bytes'].encode())
+        return obj
+
+    @classmethod
+    def write(cls, fdesc, ranges):
+        """Writes an index to `fdesc` (opened in binary mode) from
+`ranges`, an iterable of (start, stop, record) tuples, sorted and
+contiguous, with IPv4 addresses as integers.
+
+        """
+        starts = array('I')
+        record_ids = array('I')
+        records = {}
+        prev_rec = None
+        for start, _, rec in ranges:
+            rec = json.dumps(rec, sort_keys=True,
+                             default=cls._json_default).encode()
+            if rec == prev_rec:
+                continue
+            starts.append(start)
+            record_ids.append(records.setdefault(rec, len(records)))
+            prev_rec = rec
+        records = sorted(records, key=records.get)
+        if utils.ARRAY_UINT64 is None:
+            raise ValueError('No array type for 64-bit integers')
+        record_offsets = array(utils.ARRAY_UINT64, [0])
+        for rec in records:
+            record_offsets.append(record_offsets[-1] + len(rec))
+        fdesc.write(cls.HEADER.pack(cls.MAGIC, len(starts), len(records)))
+        for arr in [starts, record_ids, record_offsets]:
+            fdesc.write(arr.tobytes() if PY3 else arr.tostring())
+        for rec in records:
+            fdesc.write(rec)
+
+    def get_record(self, rec_id):
+        try:
+            return self._records_cache[rec_id]
+        except KeyError:
+            pass
+        record = json.loads(self.data[
+            self.records_start + self.record_offsets[rec_id]:
+            self.records_start + self.record_offsets[rec_id + 1]
+        ].decode(), object_hook=self._json_object_hook)
+        if self.records_cache_size != 0:
+            if (self.records_cache_size is not None and
+                    len(self._records_cache) >= self.records_cache_size):
+                self._records_cache.popitem(last=False)
+            self._records_cache[rec_id] = record
+        return record
+
+    def lookup_prefix(self, addr):
+        """Same as `MaxMindFile.lookup_prefix()`, for an IPv4 address
+(as an integer). The prefix is the largest network that contains
+`addr` and is included in its range.
+
+        """
+        idx = bisect_right(self.starts, addr) - 1
+        start = self.starts[idx]
+        try:
+            stop = self.starts[idx + 1] - 1
+        except IndexError:
+            stop = 0xffffffff
+        size = 0
+        while size < 32:
+            mask = (1 << (size + 1)) - 1
+            if addr & ~mask < start or addr | mask > stop:
+                break
+            size += 1
+        return 128 - size, self.get_record(self.record_ids[idx])
+
+
 class EmptyMaxMindFile(object):
 
     """Stub to replace MaxMind databases parsers. Used when a file is
@@ -97,6 +246,18 @@ missing to emit a warning message and return empty results.
     def lookup(self, _):
         return {}
 
+    @staticmethod
+    def lookup_prefix(_):
+        return 0, {}
+
+    @staticmethod
+    def lookup_many(ips):
+        return [{} for _ in ips]
+
+    @staticmethod
+    def lookup_prefix_many(ips):
+        return [(0, {}) for _ in ips]
+
 
 class MaxMindFile(object):
 
@@ -115,8 +276,19 @@ class MaxMindFile(object):
     def __init__(self, path):
         self.path = path
         self._data = None
-        pos = (self.data.rindex(self.METADATA_BEGIN_MARKER) +
-               len(self.METADATA_BEGIN_MARKER))
+        # Cache for the decoded records, {offset: record}: many tree
+        # leaves point to the same data section offset. The oldest
+        # entries are discarded first when records_cache_size (None
+        # for no limit) is reached.
+        self.records_cache_size = config.GEOIP_RECORDS_CACHE_SIZE
+        self._records_cache = utils.OrderedDict()
+        self.data_section_start = None
+        # When set (see .load_ranges_index()), used for IPv4 lookups
+        self.ranges_index = None
+        pos = self.data.rfind(self.METADATA_BEGIN_MARKER)
+        if pos == -1:
+            raise ValueError('Invalid file format (no metadata) %r' % path)
+        pos += len(self.METADATA_BEGIN_MARKER)
         metadata = self.metadata = self.decode(pos, 0)[1]
         self.ip_version = metadata['ip_version']
         self.node_count = metadata['node_count']
@@ -127,26 +299,31 @@ class MaxMindFile(object):
 
     @property
     def data(self):
+        """The file content, memory-mapped (read-only): the pages are
+shared between the processes using the same file, and only the parts
+actually used are loaded.
+
+Values are read from it using struct.unpack_from() to avoid copies.
+
+        """
         if self._data is None:
             with open(self.path, 'rb') as fdesc:
-                self._data = fdesc.read()
+                self._data = mmap.mmap(fdesc.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
         return self._data
 
     def read_byte(self, pos):
-        return ord(self.data[pos:pos + 1])
+        return UINT8.unpack_from(self.data, pos)[0]
 
     def read_value(self, pos, size):
         return reduce(
             lambda x, y: (x << 8) + y,
-            struct.unpack(
-                '%dB' % size,
-                self.data[pos:pos + size],
-            ),
+            struct.unpack_from('%dB' % size, self.data, pos),
             0,
         )
 
     def decode(self, pos, base_pos):
-        ctrl = ord(self.data[pos + base_pos:pos + base_pos + 1])
+        ctrl = self.read_byte(pos + base_pos)
         pos += 1
         type_ = ctrl >> 5
         if type_ == 1:
@@ -156,6 +333,8 @@ class MaxMindFile(object):
             val2 = self.read_value(pos + base_pos, size)
             pointer = ((val1 << (8 * size)) + val2 +
                        self.POINTER_BASE_VALUES[size])
+            if base_pos == self.data_section_start:
+                return pos + size, self.decode_record(pointer)
             return pos + size, self.decode(pointer, base_pos)[1]
         if type_ == 0:
             # extended type
@@ -176,9 +355,8 @@ class MaxMindFile(object):
         elif type_ in [3, 15]:
             # double
             # float
-            val = struct.unpack(
-                {3: '>d', 15: '>f'}[type_],
-                self.data[pos + base_pos:pos + base_pos + size],
+            val = struct.unpack_from(
+                {3: '>d', 15: '>f'}[type_], self.data, pos + base_pos,
             )[0]
             pos += size
         elif type_ == 4:
@@ -201,11 +379,10 @@ class MaxMindFile(object):
                 val[k] = v
         elif type_ == 8:
             # signed 32-bit int
-            v1 = struct.unpack(
-                '>i', self.data[pos + base_pos:pos + base_pos + size]
-            )[0]
-            bits = size * 8
-            val = (v1 & ~(1 << bits)) - (v1 & (1 << bits))
+            # shorter values are zero-padded (i.e., positive)
+            val = self.read_value(pos + base_pos, size)
+            if size == 4 and val & 0x80000000:
+                val -= 0x100000000
             pos += size
         elif type_ == 11:
             # array
@@ -227,6 +404,24 @@ class MaxMindFile(object):
             raise Exception('TODO type == %d (unknown)' % type_)
         return pos, val
 
+    def decode_record(self, pos):
+        """Returns the record at offset `pos` in the data section, from the
+cache when possible. The returned value is shared between the callers
+and must not be modified.
+
+        """
+        try:
+            return self._records_cache[pos]
+        except KeyError:
+            pass
+        record = self.decode(pos, self.data_section_start)[1]
+        if self.records_cache_size != 0:
+            if (self.records_cache_size is not None and
+                    len(self._records_cache) >= self.records_cache_size):
+                self._records_cache.popitem(last=False)
+            self._records_cache[pos] = record
+        return record
+
     def read_record(self, node_no, flag):
         rec_byte_size = self.node_byte_size // 2
         pos = self.node_byte_size * node_no
@@ -245,9 +440,101 @@ class MaxMindFile(object):
         return '<%s from %s>' % (self.__class__.__name__, self.path)
 
     def lookup(self, ip):
-        node_no = 0
+        return self.lookup_prefix(ip)[1]
+
+    def lookup_prefix(self, ip):
+        """Returns a tuple (prefixlen, record), where `record` is the data
+associated with `ip`, and `prefixlen` is the length (in the IPv6
+address space, where IPv4 addresses are ::a.b.c.d) of the network
+prefix of the tree leaf that holds it: all the addresses within that
+network have the same record.
+
+        """
         addr = utils.force_ip2int(ip)
-        for i in range(96 if self.ip_version == 4 else 0, 128):
+        if addr <= 0xffffffff:
+            if self.ranges_index is not None:
+                return self.ranges_index.lookup_prefix(addr)
+            if self.ipv4_start is not None:
+                return self._walk(addr, 96, self.ipv4_start)
+        return self._walk(addr, 96 if self.ip_version == 4 else 0, 0)
+
+    def lookup_many(self, ips):
+        """Same as [self.lookup(ip) for ip in ips], but faster for large
+batches of addresses; see `.lookup_prefix_many()`.
+
+        """
+        return [record for _, record in self.lookup_prefix_many(ips)]
+
+    def lookup_prefix_many(self, ips):
+        """Same as [self.lookup_prefix(ip) for ip in ips], but faster for
+large batches of addresses: the addresses are sorted, so that the
+tree is only walked once for the prefix shared by consecutive
+addresses, and only once for addresses in the same leaf network.
+
+Results are returned in the same order as `ips`.
+
+        """
+        if self.ranges_index is not None:
+            return [self.lookup_prefix(ip) for ip in ips]
+        start = 96 if self.ip_version == 4 else 0
+        # only the last (128 - start) bits are used
+        mask = (1 << (128 - start)) - 1
+        results = [None] * len(ips)
+        # path[k] is the node at depth start + k for the previous
+        # address
+        path = [0]
+        prev_addr = None
+        prev_result = None
+        for addr, idx in sorted((utils.force_ip2int(ip) & mask, idx)
+                                for idx, ip in enumerate(ips)):
+            if prev_addr is None:
+                depth = start
+            else:
+                # number of leading bits shared with the previous
+                # address (len(bin()) rather than int.bit_length()
+                # for Python 2.6)
+                diff = addr ^ prev_addr
+                depth = 128 - (len(bin(diff)) - 2) if diff else 128
+                if depth >= prev_result[0]:
+                    # same leaf network
+                    results[idx] = prev_result
+                    continue
+                del path[depth - start + 1:]
+            prev_addr = addr
+            results[idx] = prev_result = self._walk(addr, depth,
+                                                    path[depth - start],
+                                                    path=path)
+        return results
+
+    @property
+    def ipv4_start(self):
+        """The node for ::/96 (the IPv4 addresses) in an IPv6 database,
+None when the file is an IPv4 database or when that node does not
+exist.
+
+        """
+        try:
+            return self._ipv4_start
+        except AttributeError:
+            pass
+        self._ipv4_start = None
+        if self.ip_version == 6:
+            node_no = 0
+            for _ in range(96):
+                node_no = self.read_record(node_no, 0)
+                if node_no == 0 or node_no >= self.node_count:
+                    break
+            else:
+                self._ipv4_start = node_no
+        return self._ipv4_start
+
+    def _walk(self, addr, depth, node_no, path=None):
+        """Walks the tree for `addr`, from `node_no` at `depth`, and
+returns (prefixlen, record). When `path` is provided, the nodes
+reached are appended to it.
+
+        """
+        for i in range(depth, 128):
             flag = (addr >> (127 - i)) & 1
             next_node_no = self.read_record(node_no, flag)
             if next_node_no == 0:
@@ -255,13 +542,47 @@ class MaxMindFile(object):
             if next_node_no >= self.node_count:
                 pos = (next_node_no - self.node_count -
                        self.DATA_SECTION_SEPARATOR_SIZE)
-                return self.decode(pos, self.data_section_start)[1]
+                return i + 1, self.decode_record(pos)
             node_no = next_node_no
+            if path is not None:
+                path.append(node_no)
         raise Exception('Invalid file format')
 
     def __iter__(self):
         return MaxMindFileIter(self)
 
+    @property
+    def ranges_index_path(self):
+        return self.path[:-4] + 'dump-IPv4.idx'
+
+    def write_ranges_index(self, fdesc):
+        """Writes the IPv4 ranges index (see `MaxMindRangesIndex`) to
+`fdesc` (opened in binary mode).
+
+        """
+        def _ipv4_ranges():
+            for start, stop, rec in self:
+                if start > 0xffffffff:
+                    break
+                yield start, stop, rec
+        MaxMindRangesIndex.write(fdesc, _ipv4_ranges())
+
+    def load_ranges_index(self):
+        """Uses the IPv4 ranges index for lookups when it exists and is
+newer than the database file.
+
+        """
+        self.ranges_index = None
+        path = self.ranges_index_path
+        if not (MaxMindRangesIndex.AVAILABLE and
+                utils.is_newer(path, self.path)):
+            return
+        try:
+            self.ranges_index = MaxMindRangesIndex(path)
+        except (IOError, ValueError, struct.error):
+            utils.LOGGER.warning('Cannot use ranges index %r', path,
+                                 exc_info=True)
+
     @staticmethod
     def _get_fields(rec, fields):
         for field in fields:
@@ -345,6 +666,7 @@ class MaxMindDBData(DBData):
         if sys.platform == 'win32' and self.basepath.startswith('/'):
             # Strip the leading / for Windows
             self.basepath = self.basepath[1:]
+        self.infos_cache_size = config.GEOIP_CACHE_SIZE
         self.reload_files()
 
     def reload_files(self):
@@ -354,16 +676,135 @@ class MaxMindDBData(DBData):
                 name = subdb.metadata['database_type'].lower()
                 if name.startswith('geolite2-'):
                     name = name[9:]
+                subdb.load_ranges_index()
                 setattr(self, "_db_%s" % name, subdb)
+        self.clear_infos_cache()
+
+    def clear_infos_cache(self):
+        """Empties the cache used by `.infos_byip()` and resets its
+statistics.
+
+        """
+        # {(prefixlen, network): infos}, the least recently used
+        # first
+        self._infos_cache = utils.OrderedDict()
+        # prefix lengths that (may) exist in the cache, the longest
+        # first
+        self._infos_cache_prefixlens = []
+        self.infos_cache_hits = 0
+        self.infos_cache_misses = 0
+
+    def infos_byip(self, addr, addr_type=True):
+        """Returns the data from the AS, Country and City databases
+for `addr` (plus the address type, unless `addr_type` is False), as a
+dict, or None when no data is available.
+
+Results are cached, using as a key the network prefix of the most
+specific tree leaf among the databases: the addresses within that
+network get the same results (e.g., the whole /24 when it is stored
+as such in the databases). The cache keeps (at most)
+`.infos_cache_size` entries, the least recently used are discarded
+first; `.infos_cache_hits` and `.infos_cache_misses` count the
+lookups.
+
+        """
+        intaddr = utils.force_ip2int(addr)
+        infos = None
+        for prefixlen in self._infos_cache_prefixlens:
+            key = (prefixlen, intaddr >> (128 - prefixlen))
+            try:
+                infos = self._infos_cache.pop(key)
+            except KeyError:
+                continue
+            self._infos_cache[key] = infos
+            self.infos_cache_hits += 1
+            break
+        else:
+            self.infos_cache_misses += 1
+            prefixlens = []
+            infos = {}
+            for subdb, getinfos in self._infos_getters():
+                prefixlen, raw = subdb.lookup_prefix(intaddr)
+                prefixlens.append(prefixlen)
+                infos.update(getinfos(raw) or {})
+            # The leaves of the different databases that hold addr
+            # are nested networks: the longest prefix is the one for
+            # which all the results are valid.
+            prefixlen = max(prefixlens)
+            if self.infos_cache_size:
+                if prefixlen not in self._infos_cache_prefixlens:
+                    self._infos_cache_prefixlens.append(prefixlen)
+                    self._infos_cache_prefixlens.sort(reverse=True)
+                self._infos_cache[
+                    (prefixlen, intaddr >> (128 - prefixlen))
+                ] = infos
+                while len(self._infos_cache) > self.infos_cache_size:
+                    self._infos_cache.popitem(last=False)
+        infos = dict(infos)
+        if addr_type:
+            self._add_addr_type(infos, addr)
+        if infos:
+            return infos
+        return None
+
+    def infos_byip_many(self, addrs, addr_type=True):
+        """Same as [self.infos_byip(addr, addr_type=addr_type) for addr in
+addrs], but faster for large batches of addresses, since each database
+is walked once for the whole batch (see
+`MaxMindFile.lookup_prefix_many()`). This does not use the
+`.infos_byip()` cache.
+
+        """
+        intaddrs = [utils.force_ip2int(addr) for addr in addrs]
+        results = [{} for _ in intaddrs]
+        for subdb, getinfos in self._infos_getters():
+            # Records are shared between the addresses of the same
+            # leaf: compute the infos once per record.
+            converted = {}
+            for infos, (_, raw) in zip(results,
+                                       subdb.lookup_prefix_many(intaddrs)):
+                try:
+                    infos.update(converted[id(raw)][1])
+                except KeyError:
+                    value = converted[id(raw)] = (raw, getinfos(raw) or {})
+                    infos.update(value[1])
+        if addr_type:
+            for infos, addr in zip(results, addrs):
+                self._add_addr_type(infos, addr)
+        return [infos or None for infos in results]
+
+    def _infos_getters(self):
+        """Returns the (database, function) tuples used to get the
+infos for an address; the function converts a record from the
+database.
+
+        """
+        return [
+            (self.db_country, self._country_infos),
+            (self.db_asn, self._as_infos),
+            (self.db_city, self._location_infos),
+        ]
+
+    @staticmethod
+    def _add_addr_type(infos, addr):
+        value = utils.get_addr_type(addr if isinstance(addr, basestring)
+                                    else utils.int2ip(addr))
+        if value:
+            infos['address_type'] = value
 
     def as_byip(self, addr):
+        return self._as_infos(self.db_asn.lookup(addr))
+
+    def _as_infos(self, raw):
         return dict(
             (self.AS_KEYS.get(key, key), value)
-            for key, value in viewitems(self.db_asn.lookup(addr))
+            for key, value in viewitems(raw)
         )
 
     def location_byip(self, addr):
-        raw = self.db_city.lookup(addr)
+        return self._location_infos(self.db_city.lookup(addr))
+
+    def _location_infos(self, raw):
         result = {}
         sub = raw.get('subdivisions')
         if sub:
@@ -413,8 +854,10 @@ class MaxMindDBData(DBData):
         return None
 
     def country_byip(self, addr):
+        return self._country_infos(self.db_country.lookup(addr))
+
+    def _country_infos(self, raw):
         result = {}
-        raw = self.db_country.lookup(addr)
         sub = raw.get('country')
         if sub:
             value = sub.get('iso_code')
@@ -461,6 +904,13 @@ class MaxMindDBData(DBData):
             ))
 
     def build_dumps(self, force=False):
+        """Creates, for each database file, the CSV dump of the IPv4
+ranges used by `ivre.geoiputils` (and its indexes, see
+`ivre.geoiputils.RangesIndex`) and the IPv4 ranges index (see
+`MaxMindRangesIndex`) used for lookups. Files newer than the files
+they are created from are skipped unless `force` is True.
+
+        """
         for attr, func in [
                 ("db_asn", self.dump_as_ranges),
                 ("db_country", self.dump_country_ranges),
@@ -470,22 +920,39 @@ class MaxMindDBData(DBData):
                 subdb = getattr(self, attr)
             except AttributeError:
                 continue
-            if not subdb.path.endswith('.mmdb'):
+            if not getattr(subdb, 'path', '').endswith('.mmdb'):
                 continue
             csv_file = subdb.path[:-4] + 'dump-IPv4.csv'
-            if not force:
-                mmdb_mtime = os.path.getmtime(subdb.path)
-                try:
-                    csv_mtime = os.path.getmtime(csv_file)
-                except OSError:
-                    pass
-                else:
-                    if csv_mtime > mmdb_mtime:
-                        utils.LOGGER.info('Skipping %r since %r is newer',
-                                          os.path.basename(subdb.path),
-                                          os.path.basename(csv_file))
-                        continue
-            utils.LOGGER.info('Dumping %r to %r', os.path.basename(subdb.path),
-                              os.path.basename(csv_file))
-            with codecs.open(csv_file, mode="w", encoding='utf-8') as fdesc:
-                func(fdesc)
+            if not force and utils.is_newer(csv_file, subdb.path):
+                utils.LOGGER.info('Skipping %r since %r is newer',
+                                  os.path.basename(subdb.path),
+                                  os.path.basename(csv_file))
+            else:
+                utils.LOGGER.info('Dumping %r to %r',
+                                  os.path.basename(subdb.path),
+                                  os.path.basename(csv_file))
+                with codecs.open(csv_file, mode="w",
+                                 encoding='utf-8') as fdesc:
+                    func(fdesc)
+            geoiputils.RangesIndex.build_all(os.path.basename(csv_file),
+                                             force=force)
+            idx_file = subdb.ranges_index_path
+            if not MaxMindRangesIndex.AVAILABLE:
+                utils.LOGGER.info('Skipping %r: ranges indexes are only '
+                                  'used with Python 3',
+                                  os.path.basename(idx_file))
+            elif not force and utils.is_newer(idx_file, subdb.path):
+                utils.LOGGER.info('Skipping %r since %r is newer',
+                                  os.path.basename(subdb.path),
+                                  os.path.basename(idx_file))
+            else:
+                utils.LOGGER.info('Indexing %r to %r',
+                                  os.path.basename(subdb.path),
+                                  os.path.basename(idx_file))
+                # The index file may be in use (memory-mapped) by other
+                # processes: write a new file and replace the old one.
+                with open(idx_file + '.tmp', 'wb') as fdesc:
+                    subdb.write_ranges_index(fdesc)
+                getattr(os, 'replace', os.rename)(idx_file + '.tmp',
+                                                  idx_file)
+            subdb.load_ranges_index()
@@ -37,6 +37,7 @@ import random
 import re
 import socket
 import struct
+import threading
 import time
 try:
     from urllib.parse import unquote
@@ -46,7 +47,7 @@ import uuid
 
 import bson
 from future.builtins import bytes, range, zip
-from future.utils import viewitems, with_metaclass
+from future.utils import viewitems, viewvalues, with_metaclass
 from past.builtins import basestring
 from pymongo.errors import BulkWriteError
 import pymongo
@@ -936,6 +937,7 @@ class MongoDBActive(MongoDB, DBActive):
 
     def __init__(self, url):
         super(MongoDBActive, self).__init__(url)
+        self.bulk_hosts = None
         self.schema_migrations = [
             # hosts
             {
@@ -1634,7 +1636,55 @@ it is not expected)."""
                  for res in cur),
                 cur.count())
 
-    def store_host(self, host):
+    def start_store_hosts(self):
+        """Hosts stored between this call and the next call to
+`.stop_store_hosts()` are buffered and inserted using unordered bulk
+operations of (at most) `config.MONGODB_HOSTS_BATCH_SIZE` hosts.
+
+        """
+        if self.bulk_hosts:
+            self.flush_store_hosts()
+        self.bulk_hosts = []
+
+    def stop_store_hosts(self):
+        """Inserts the hosts still buffered and stops buffering."""
+        if self.bulk_hosts:
+            self.flush_store_hosts()
+        self.bulk_hosts = None
+
+    def flush_store_hosts(self):
+        """Inserts the buffered hosts, using an unordered bulk
+operation. Errors are reported for the whole batch.
+
+        """
+        hosts, self.bulk_hosts = self.bulk_hosts, []
+        bulk = self.db[
+            self.columns[self.column_hosts]
+        ].initialize_unordered_bulk_op()
+        for host in hosts:
+            bulk.insert(host)
+        errors = set()
+        try:
+            bulk.execute()
+        except BulkWriteError as exc:
+            utils.LOGGER.error(
+                "DB:MongoDB bulk insert in %r: %d/%d hosts stored, errors: %r",
+                self.columns[self.column_hosts],
+                exc.details.get('nInserted', 0), len(hosts),
+                exc.details.get('writeErrors'),
+            )
+            errors.update(err.get('index')
+                          for err in exc.details.get('writeErrors', []))
+        for i, host in enumerate(hosts):
+            if i not in errors:
+                utils.LOGGER.debug("HOST STORED: %r in %r", host['_id'],
+                                   self.columns[self.column_hosts])
+
+    def host2internal(self, host):
+        """Returns a copy of `host`, converted to the format used in the
+database.
+
+        """
         host = deepcopy(host)
         # Convert IP addresses to internal DB format
         try:
@@ -1667,6 +1717,18 @@ it is not expected)."""
                 "type": "Point",
                 "coordinates": host['infos'].pop('coordinates')[::-1],
             }
+        return host
+
+    def store_host(self, host):
+        host = self.host2internal(host)
+        if self.bulk_hosts is not None:
+            # The _id is generated client-side, so that we can
+            # return it as insert() does.
+            ident = host.setdefault('_id', bson.ObjectId())
+            self.bulk_hosts.append(host)
+            if len(self.bulk_hosts) >= config.MONGODB_HOSTS_BATCH_SIZE:
+                self.flush_store_hosts()
+            return ident
         ident = self.db[self.columns[self.column_hosts]].insert(host)
         utils.LOGGER.debug("HOST STORED: %r in %r", ident,
                            self.columns[self.column_hosts])
@@ -3903,21 +3965,56 @@ setting values according to the keyword arguments.
                               separated_timestamps=True):
         """Like `.insert_or_update()`, but `specs` parameter has to be an
         iterable of (timestamp, spec) values. This will perform bulk
-        MongoDB inserts with the major drawback that the `getinfos`
-        parameter will be called (if it is not `None`) for each spec,
-        even when the spec already exists in the database and the call
-        was hence unnecessary.
-
-        It's up to you to decide whether having bulk insert is worth
-        it or if you want to go with the regular `.insert_or_update()`
-        method.
+        MongoDB upserts, in two phases: the "count", "firstseen" and
+        "lastseen" values are upserted first, then the `getinfos`
+        parameter is called (if it is not `None`) only for the specs
+        that have been inserted (as reported by the bulk result, or by
+        the BulkWriteError exception), and a second bulk operation sets
+        their "infos" value. The two phases are not atomic: a record
+        inserted by a process that dies before the second one has no
+        "infos" value.
 
         """
-        bulk = self.db[
-            self.columns[self.column_passive]
-        ].initialize_unordered_bulk_op()
+        column = self.db[self.columns[self.column_passive]]
+        bulk = column.initialize_unordered_bulk_op()
+        # the specs (as presented to the user) of the current bulk
+        # operation, so that getinfos() can be called on those that
+        # get inserted
+        origs = []
         count = 0
 
+        def execute(bulk, origs):
+            try:
+                result = bulk.execute()
+            except BulkWriteError as exc:
+                # the specs that have been inserted anyway must get
+                # their infos, since the next upserts will not report
+                # them as inserted
+                set_infos(exc.details.get('upserted'), origs)
+                raise
+            set_infos(result.get('upserted'), origs)
+
+        def set_infos(upserted_list, origs):
+            if getinfos is None or not upserted_list:
+                return
+            infosbulk = column.initialize_unordered_bulk_op()
+            count = 0
+            for upserted in upserted_list:
+                orig = origs[upserted['index']]
+                orig.update(getinfos(orig))
+                try:
+                    infos = {'infos': orig['infos']}
+                except KeyError:
+                    continue
+                self._fix_sizes(infos)
+                infosbulk.find({'_id': upserted['_id']}).update_one(
+                    {'$set': infos}
+                )
+                count += 1
+            if count:
+                utils.LOGGER.debug("DB:MongoDB bulk set infos: %d", count)
+                infosbulk.execute()
+
         if separated_timestamps:
             def generator(specs):
                 for timestamp, spec in specs:
@@ -3933,39 +4030,36 @@ setting values according to the keyword arguments.
                 if spec is None:
                     continue
                 updatespec = {
-                    '$inc': {'count': 1},
+                    '$inc': {'count': spec.pop("count", 1)},
                     '$min': {'firstseen': firstseen},
                     '$max': {'lastseen': lastseen},
                 }
                 if getinfos is not None:
-                    spec.update(getinfos(spec))
-                    try:
-                        infos = {'infos': spec['infos']}
-                    except KeyError:
-                        pass
-                    else:
-                        self._fix_sizes(infos)
-                        updatespec['$setOnInsert'] = infos
+                    # .rec2internal() replaces top-level values and
+                    # truncates "infos" values
+                    orig = dict(spec)
+                    if 'infos' in spec:
+                        orig['infos'] = dict(spec['infos'])
+                    origs.append(orig)
                 spec = self.rec2internal(spec)
-                findspec = deepcopy(spec)
                 for key in ['infos', 'fullinfos']:
                     try:
-                        del findspec[key]
+                        del spec[key]
                     except KeyError:
                         pass
-                bulk.find(findspec).upsert().update(updatespec)
+                bulk.find(spec).upsert().update(updatespec)
                 count += 1
                 if count >= config.MONGODB_BATCH_SIZE:
                     utils.LOGGER.debug("DB:MongoDB bulk upsert: %d", count)
-                    bulk.execute()
-                    bulk = self.db[self.columns[self.column_passive]]\
-                               .initialize_unordered_bulk_op()
+                    execute(bulk, origs)
+                    bulk = column.initialize_unordered_bulk_op()
+                    origs = []
                     count = 0
         except IOError:
             pass
         if count > 0:
             utils.LOGGER.debug("DB:MongoDB bulk upsert: %d (final)", count)
-            bulk.execute()
+            execute(bulk, origs)
 
     def insert_or_update_mix(self, spec, getinfos=None):
         """Updates the first record matching "spec" (without
@@ -4538,6 +4632,167 @@ scan object on success, and raises a LockError on failure.
                               fields=["_id"])))
 
 
+class MongoDBFlowBulk(object):
+    """Client-side aggregation buffer for flow upserts, returned by
+    `MongoDBFlow.start_bulk_insert()`.
+
+    The update specs ($min, $max, $inc, $addToSet and $set operators)
+    of the records that share the same flow key (see
+    `MongoDBFlow._get_flow_key()`) are merged in memory, and written
+    with one upsert per flow, in an unordered bulk. This happens when
+    `config.MONGODB_FLOW_BATCH_SIZE` flows are buffered, when the
+    oldest buffered record is older than
+    `config.MONGODB_FLOW_BATCH_TIMEOUT` seconds (from a timer thread,
+    so that the flows of a quiet stream are not kept indefinitely),
+    and when `.flush()` is called.
+
+    """
+
+    def __init__(self, collection, size=None, timeout=None):
+        self.collection = collection
+        self.size = config.MONGODB_FLOW_BATCH_SIZE if size is None else size
+        self.timeout = (config.MONGODB_FLOW_BATCH_TIMEOUT if timeout is None
+                        else timeout)
+        # {flow key: (findspec, updatespec)}
+        self.flows = {}
+        # number of records merged in .flows
+        self.count = 0
+        # started when the first record is buffered
+        self.timer = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def _hashable(cls, value):
+        """Returns a hashable equivalent of `value`, used to merge the
+        $addToSet values (timeslots are dicts).
+
+        """
+        if isinstance(value, dict):
+            return tuple(sorted((key, cls._hashable(val))
+                                for key, val in viewitems(value)))
+        if isinstance(value, list):
+            return tuple(cls._hashable(val) for val in value)
+        return value
+
+    def add(self, findspec, updatespec):
+        """Merges `updatespec` into the update buffered for the flow
+        `findspec`.
+
+        """
+        with self.lock:
+            self._add(findspec, updatespec)
+
+    def _add(self, findspec, updatespec):
+        key = tuple(sorted(viewitems(findspec)))
+        try:
+            update = self.flows[key][1]
+        except KeyError:
+            update = {}
+            self.flows[key] = (findspec, update)
+        for op, fields in viewitems(updatespec):
+            current = update.setdefault(op, {})
+            for field, value in viewitems(fields):
+                if op == '$inc':
+                    current[field] = current.get(field, 0) + value
+                elif op == '$min':
+                    if field not in current or value < current[field]:
+                        current[field] = value
+                elif op == '$max':
+                    if field not in current or value > current[field]:
+                        current[field] = value
+                elif op == '$addToSet':
+                    # {hashable value: value}, converted to {'$each':
+                    # [value, ...]} by .flush()
+                    values = current.setdefault(field, {})
+                    if isinstance(value, dict) and '$each' in value:
+                        for val in value['$each']:
+                            values.setdefault(self._hashable(val), val)
+                    else:
+                        values.setdefault(self._hashable(value), value)
+                else:
+                    current[field] = value
+        self.count += 1
+        if len(self.flows) >= self.size:
+            self._flush()
+        elif self.timer is None:
+            self._start_timer()
+
+    def _start_timer(self):
+        if not self.timeout:
+            return
+        self.timer = threading.Timer(self.timeout, self._flush_timeout)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _flush_timeout(self):
+        """Called by the timer thread: writes the buffered flows, unless
+        they have been written (and the timer replaced) meanwhile. On
+        error, the flows are kept and the timer is started again.
+
+        """
+        with self.lock:
+            if threading.current_thread() is not self.timer:
+                return
+            try:
+                self._flush()
+            except Exception:
+                utils.LOGGER.error("Cannot write %d flows, will try again",
+                                   len(self.flows), exc_info=True)
+                self._start_timer()
+
+    def flush(self):
+        """Writes the buffered flows to the database."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        """Writes the buffered flows; when the bulk cannot be executed
+        (e.g., AutoReconnect), they are kept so that the next flush
+        tries again, and the exception is raised.
+
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.flows:
+            return
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for findspec, update in viewvalues(self.flows):
+            if '$addToSet' in update:
+                # the buffered update is not modified, in case it has
+                # to be written again
+                update = dict(update)
+                update['$addToSet'] = dict(
+                    (field, {'$each': list(viewvalues(values))})
+                    for field, values in viewitems(update['$addToSet'])
+                )
+            bulk.find(findspec).upsert().update(update)
+        utils.LOGGER.debug("%d records aggregated in %d flows", self.count,
+                           len(self.flows))
+        self.execute(bulk)
+        self.flows = {}
+        self.count = 0
+
+    @staticmethod
+    def execute(bulk):
+        """Executes a pymongo bulk and logs the result."""
+        try:
+            start_time = time.time()
+            result = bulk.execute()
+            newtime = time.time()
+            insert_rate = result.get('nInserted') / (newtime - start_time)
+            upsert_rate = result.get('nUpserted') / (newtime - start_time)
+            utils.LOGGER.debug("%d inserts, %f/sec",
+                               result.get('nInserted'), insert_rate)
+            utils.LOGGER.debug("%d upserts, %f/sec",
+                               result.get('nUpserted'), upsert_rate)
+        except BulkWriteError:
+            utils.LOGGER.error("Bulk Write Error", exc_info=True)
+        except pymongo.errors.InvalidOperation:
+            # Raised when executing an empty bulk
+            pass
+
+
 class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
     column_flow = 0
 
@@ -4588,8 +4843,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         Returns flow_bulk
         """
         utils.LOGGER.debug("start_bulk_insert called")
-        return (self.db[self.columns[self.column_flow]]
-                .initialize_unordered_bulk_op())
+        return MongoDBFlowBulk(self.db[self.columns[self.column_flow]])
 
     @staticmethod
     def _get_flow_key(rec):
@@ -4663,7 +4917,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
 
         cls._update_timeslots(updatespec, rec)
 
-        bulk.find(findspec).upsert().update(updatespec)
+        bulk.add(findspec, updatespec)
 
     @classmethod
     def conn2flow(cls, bulk, rec):
@@ -4693,7 +4947,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         elif rec['proto'] == 'icmp':
             updatespec.setdefault("$addToSet", {})["codes"] = rec["code"]
 
-        bulk.find(findspec).upsert().update(updatespec)
+        bulk.add(findspec, updatespec)
 
     @classmethod
     def flow2flow(cls, bulk, rec):
@@ -4723,26 +4977,11 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         elif rec['proto'] == 'icmp':
             updatespec.setdefault("$addToSet", {})["codes"] = rec["code"]
 
-        bulk.find(findspec).upsert().update(updatespec)
+        bulk.add(findspec, updatespec)
 
     @staticmethod
     def bulk_commit(bulk):
-        try:
-            start_time = time.time()
-            result = bulk.execute()
-            newtime = time.time()
-            insert_rate = result.get('nInserted') / (newtime - start_time)
-            upsert_rate = result.get('nUpserted') / (newtime - start_time)
-            utils.LOGGER.debug("%d inserts, %f/sec",
-                               result.get('nInserted'), insert_rate)
-            utils.LOGGER.debug("%d upserts, %f/sec",
-                               result.get('nUpserted'), upsert_rate)
-
-        except BulkWriteError:
-            utils.LOGGER.error("Bulk Write Error", exc_info=True)
-        except pymongo.errors.InvalidOperation:
-            # Raised when executing an empty bulk
-            pass
+        bulk.flush()
 
     def get(self, flt, skip=None, limit=None, orderby=None, fields=None):
         """
@@ -5609,7 +5848,10 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
             },
         ]
         res = self.db[self.columns[self.column_flow]].aggregate(pipeline)
-        bulk = self.start_bulk_insert()
+        # the flows are removed, so a pymongo bulk is used rather than
+        # .start_bulk_insert()
+        bulk = (self.db[self.columns[self.column_flow]]
+                .initialize_unordered_bulk_op())
         counter = 0
         for rec in res:
             rec['_id']['src_addr'] = self.internal2ip(
@@ -5665,5 +5907,5 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                 bulk.find(removespec).remove()
                 counter += len(rec['_ids'])
 
-        self.bulk_commit(bulk)
+        MongoDBFlowBulk.execute(bulk)
         utils.LOGGER.debug("%d flows switched.", counter)
@@ -2080,6 +2080,18 @@ returns the first result, or None if no result exists."""
     def insert_or_update(self, timestamp, spec, getinfos=None, lastseen=None):
         if spec is None:
             return
+        vals = self._spec2values(timestamp, spec, getinfos=getinfos,
+                                 lastseen=lastseen)
+        self._insert_or_update(vals['firstseen'], vals,
+                               lastseen=vals['lastseen'])
+
+    def _spec2values(self, timestamp, spec, getinfos=None, lastseen=None):
+        """Converts a passive record `spec` to a dict of values for the
+        passive table columns (the "count", "firstseen" and
+        "lastseen" fields are set from `spec`, `timestamp` and
+        `lastseen`).
+
+        """
         try:
             spec['addr'] = self.ip2internal(spec['addr'])
         except (KeyError, ValueError):
@@ -2118,7 +2130,7 @@ returns the first result, or None if no result exists."""
             'schema_version': spec.pop('schema_version', None),
         }
         vals.update(otherfields)
-        self._insert_or_update(timestamp, vals, lastseen=lastseen)
+        return vals
 
     def migrate_from_db(self, db, flt=None, limit=None, skip=None, sort=None):
         if flt is None:
@@ -28,7 +28,7 @@ import time
 
 
 from sqlalchemy import ARRAY, Column, Index, LargeBinary, String, Table, \
-    and_, cast, column, delete, desc, exists, func, insert, join, not_, \
+    and_, cast, column, desc, exists, func, insert, join, not_, \
     nullsfirst, select, text, tuple_, update
 from sqlalchemy.dialects import postgresql
 
@@ -56,7 +56,7 @@ class PostgresDB(SQLDB):
         trans.commit()
         conn.close()
 
-    def create_tmp_table(self, table, extracols=None):
+    def create_tmp_table(self, table, extracols=None, bind=None):
         cols = [c.copy() for c in table.__table__.columns]
         for c in cols:
             c.index = False
@@ -70,7 +70,7 @@ class PostgresDB(SQLDB):
         t = Table("tmp_%s" % table.__tablename__,
                   table.__table__.metadata, *cols,
                   prefixes=['TEMPORARY'])
-        t.create(bind=self.db, checkfirst=True)
+        t.create(bind=self.db if bind is None else bind, checkfirst=True)
         return t
 
     def start_bulk_insert(self, size=None, retries=0):
@@ -1347,6 +1347,57 @@ class PostgresDBPassive(PostgresDB, SQLDBPassive):
             )
         self.db.execute(stmt)
 
+    def _merge_tmp_stmt(self, tmp, with_addr):
+        """Returns the INSERT ... SELECT ... ON CONFLICT DO UPDATE
+        statement that merges the records of the staging table `tmp`
+        with (`with_addr` is True) or without an address into the
+        passive table.
+
+        The records are grouped by the columns of the (partial) unique
+        index, so that a record of the passive table cannot be
+        affected twice by the same statement.
+
+        """
+        passive = self.tables.passive
+        keys = ['sensor', 'recontype', 'port', 'source', 'value',
+                'targetval', 'info']
+        if with_addr:
+            keys.insert(0, 'addr')
+            where = tmp.columns['addr'] != None  # noqa: E711
+            index_where = passive.addr != None  # noqa: E711
+        else:
+            where = tmp.columns['addr'] == None  # noqa: E711
+            index_where = passive.addr == None  # noqa: E711
+        insrt = postgresql.insert(passive)
+        return insrt.from_select(
+            [column(col) for col in keys] +
+            # sum / min / max / first
+            [column(col) for col in ['count', 'firstseen', 'lastseen',
+                                     'moreinfo']],
+            select([tmp.columns[col] for col in keys] + [
+                func.sum_(tmp.columns['count']),
+                func.min_(tmp.columns['firstseen']),
+                func.max_(tmp.columns['lastseen']),
+                postgresql.array_agg(tmp.columns['moreinfo'])[1],
+            ])
+            .where(where)
+            .group_by(*(tmp.columns[col] for col in keys))
+        ).on_conflict_do_update(
+            index_elements=keys,
+            index_where=index_where,
+            set_={
+                'firstseen': func.least(
+                    passive.firstseen,
+                    insrt.excluded.firstseen,
+                ),
+                'lastseen': func.greatest(
+                    passive.lastseen,
+                    insrt.excluded.lastseen,
+                ),
+                'count': passive.count + insrt.excluded.count,
+            },
+        )
+
     def insert_or_update_bulk(self, specs, getinfos=None,
                               separated_timestamps=True):
         """Like `.insert_or_update()`, but `specs` parameter has to be an
@@ -1357,134 +1408,58 @@ class PostgresDBPassive(PostgresDB, SQLDBPassive):
         each spec, even when the spec already exists in the database
         and the call was hence unnecessary.
 
+        Each batch of (at most) `config.POSTGRES_BATCH_SIZE` records
+        is copied to a staging (temporary) table, and then merged into
+        the passive table (see `._merge_tmp_stmt()`), in a single
+        transaction. Since a temporary table only exists in the
+        session that created it, a single connection is used.
+
         It's up to you to decide whether having bulk insert is worth
         it or if you want to go with the regular `.insert_or_update()`
         method.
 
         """
         more_to_read = True
-        tmp = self.create_tmp_table(self.tables.passive)
         if config.DEBUG_DB:
             total_upserted = 0
             total_start_time = time.time()
-        while more_to_read:
-            if config.DEBUG_DB:
-                start_time = time.time()
-            with PassiveCSVFile(specs, self.ip2internal, tmp,
-                                getinfos=getinfos,
-                                separated_timestamps=separated_timestamps,
-                                limit=config.POSTGRES_BATCH_SIZE) as fdesc:
-                self.copy_from(fdesc, tmp.name)
-                more_to_read = fdesc.more_to_read
+        with self.db.connect() as conn:
+            tmp = self.create_tmp_table(self.tables.passive, bind=conn)
+            merge_stmts = [self._merge_tmp_stmt(tmp, True),
+                           self._merge_tmp_stmt(tmp, False)]
+            while more_to_read:
                 if config.DEBUG_DB:
-                    count_upserted = fdesc.count
-            insrt = postgresql.insert(self.tables.passive)
-            self.db.execute(
-                insrt.from_select(
-                    [column(col) for col in [
-                        'addr',
-                        # sum / min / max
-                        'count', 'firstseen', 'lastseen',
-                        # grouped
-                        'sensor', 'port', 'recontype', 'source', 'targetval',
-                        'value', 'info', 'moreinfo'
-                    ]],
-                    select([tmp.columns['addr'],
-                            func.sum_(tmp.columns['count']),
-                            func.min_(tmp.columns['firstseen']),
-                            func.max_(tmp.columns['lastseen'])] + [
-                                tmp.columns[col] for col in [
-                                    'sensor', 'port', 'recontype', 'source',
-                                    'targetval', 'value', 'info', 'moreinfo'
-                                    ]])\
-                    .where(
-                        tmp.columns['addr'] != None
-                        # noqa: E711 (BinaryExpression)
-                    )\
-                    .group_by(*(tmp.columns[col] for col in [
-                        'addr', 'sensor', 'port', 'recontype', 'source',
-                        'targetval', 'value', 'info', 'moreinfo'
-                    ]))
-                )\
-                .on_conflict_do_update(
-                    index_elements=['addr', 'sensor', 'recontype', 'port',
-                                    'source', 'value', 'targetval', 'info'],
-                    index_where=self.tables.passive.addr != None,
-                    # noqa: E711 (BinaryExpression)
-                    set_={
-                        'firstseen': func.least(
-                            self.tables.passive.firstseen,
-                            insrt.excluded.firstseen,
-                        ),
-                        'lastseen': func.greatest(
-                            self.tables.passive.lastseen,
-                            insrt.excluded.lastseen,
-                        ),
-                        'count':
-                        self.tables.passive.count + insrt.excluded.count,
-                    },
-                )
-            )
-            self.db.execute(
-                insrt.from_select(
-                    [column(col) for col in [
-                        'addr',
-                        # sum / min / max
-                        'count', 'firstseen', 'lastseen',
-                        # grouped
-                        'sensor', 'port', 'recontype', 'source', 'targetval',
-                        'value', 'info', 'moreinfo'
-                    ]],
-                    select([tmp.columns['addr'],
-                            func.sum_(tmp.columns['count']),
-                            func.min_(tmp.columns['firstseen']),
-                            func.max_(tmp.columns['lastseen'])] + [
-                                tmp.columns[col] for col in [
-                                    'sensor', 'port', 'recontype', 'source',
-                                    'targetval', 'value', 'info', 'moreinfo'
-                                    ]])\
-                    .where(
-                        tmp.columns['addr'] == None
-                        # noqa: E711 (BinaryExpression)
-                    )\
-                    .group_by(*(tmp.columns[col] for col in [
-                        'addr', 'sensor', 'port', 'recontype', 'source',
-                        'targetval', 'value', 'info', 'moreinfo'
-                    ]))
-                )\
-                .on_conflict_do_update(
-                    index_elements=['sensor', 'recontype', 'port', 'source',
-                                    'value', 'targetval', 'info'],
-                    index_where=self.tables.passive.addr == None,
-                    # noqa: E711 (BinaryExpression)
-                    set_={
-                        'firstseen': func.least(
-                            self.tables.passive.firstseen,
-                            insrt.excluded.firstseen,
-                        ),
-                        'lastseen': func.greatest(
-                            self.tables.passive.lastseen,
-                            insrt.excluded.lastseen,
-                        ),
-                        'count':
-                        self.tables.passive.count + insrt.excluded.count,
-                    },
-                )
-            )
-            self.db.execute(delete(tmp))
-            if config.DEBUG_DB:
-                stop_time = time.time()
-                time_spent = stop_time - start_time
-                total_upserted += count_upserted
-                total_time_spent = stop_time - total_start_time
-                utils.LOGGER.debug(
-                    "DB:PERFORMANCE STATS %s upserts, %f s, %s/s\n"
-                    "\ttotal: %s upserts, %f s, %s/s",
-                    utils.num2readable(count_upserted), time_spent,
-                    utils.num2readable(count_upserted / time_spent),
-                    utils.num2readable(total_upserted), total_time_spent,
-                    utils.num2readable(total_upserted / total_time_spent),
-                )
+                    start_time = time.time()
+                with conn.begin():
+                    with PassiveCSVFile(
+                            specs, self.ip2internal, tmp, getinfos=getinfos,
+                            separated_timestamps=separated_timestamps,
+                            limit=config.POSTGRES_BATCH_SIZE,
+                    ) as fdesc:
+                        conn.connection.cursor().copy_from(fdesc, tmp.name)
+                        more_to_read = fdesc.more_to_read
+                        if config.DEBUG_DB:
+                            count_upserted = fdesc.count
+                    for stmt in merge_stmts:
+                        conn.execute(stmt)
+                    # TRUNCATE rather than DELETE: no dead rows left
+                    # to scan in the next batches
+                    conn.execute(text("TRUNCATE %s" % tmp.name))
+                if config.DEBUG_DB:
+                    stop_time = time.time()
+                    time_spent = stop_time - start_time
+                    total_upserted += count_upserted
+                    total_time_spent = stop_time - total_start_time
+                    utils.LOGGER.debug(
+                        "DB:PERFORMANCE STATS %s upserts, %f s, %s/s\n"
+                        "\ttotal: %s upserts, %f s, %s/s",
+                        utils.num2readable(count_upserted), time_spent,
+                        utils.num2readable(count_upserted / time_spent),
+                        utils.num2readable(total_upserted),
+                        total_time_spent,
+                        utils.num2readable(total_upserted /
+                                           total_time_spent),
+                    )
 
     def _features_port_get(self, features, flt, yieldall, use_service,
                            use_product, use_version):
@@ -23,8 +23,7 @@ databases.
 """
 
 
-from sqlalchemy import Index, and_, func, insert, update
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import Index, bindparam, text
 
 from ivre import utils, config
 from ivre.db.sql import SQLDB, SQLDBPassive
@@ -64,36 +63,79 @@ class SqliteDBPassive(SqliteDB, SQLDBPassive):
         )
 
     def _insert_or_update(self, timestamp, values, lastseen=None):
-        stmt = insert(self.tables.passive)\
-            .values(dict(values, addr=utils.force_int2ip(values['addr'])))
+        self.db.execute(self._upsert_stmt,
+                        dict(values, addr=utils.force_int2ip(values['addr'])))
+
+    @property
+    def _upsert_stmt(self):
+        """The INSERT ... ON CONFLICT DO UPDATE statement used by
+`._insert_or_update()` and `.insert_or_update_bulk()`, built once and
+then reused so that the same prepared statement is used for every
+record.
+
+        """
         try:
-            self.db.execute(stmt)
-        except IntegrityError:
-            whereclause = and_(
-                self.tables.passive.addr == values['addr'],
-                self.tables.passive.sensor == values['sensor'],
-                self.tables.passive.recontype == values['recontype'],
-                self.tables.passive.source == values['source'],
-                self.tables.passive.value == values['value'],
-                self.tables.passive.targetval == values['targetval'],
-                self.tables.passive.info == values['info'],
-                self.tables.passive.port == values['port']
-            )
-            upsert = {
-                'firstseen': func.least(
-                    self.tables.passive.firstseen,
-                    timestamp,
-                ),
-                'lastseen': func.greatest(
-                    self.tables.passive.lastseen,
-                    lastseen or timestamp,
-                ),
-                'count': self.tables.passive.count + values['count'],
+            return self._upsert
+        except AttributeError:
+            pass
+        table = self.tables.passive.__table__
+        columns = ['addr', 'sensor', 'count', 'firstseen', 'lastseen', 'port',
+                   'recontype', 'source', 'targetval', 'value', 'info',
+                   'moreinfo', 'schema_version']
+        # The addr column is never NULL (see DefaultINET), so the
+        # conflicts are always on the ix_passive_record index.
+        self._upsert = text(
+            "INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s) "
+            "ON CONFLICT (addr, sensor, recontype, port, source, value, "
+            "targetval, info) WHERE addr IS NOT NULL DO UPDATE SET "
+            "firstseen = MIN(%(table)s.firstseen, excluded.firstseen), "
+            "lastseen = MAX(%(table)s.lastseen, excluded.lastseen), "
+            "count = %(table)s.count + excluded.count" % {
+                'table': table.name,
+                'columns': ', '.join(columns),
+                'values': ', '.join(':%s' % col for col in columns),
             }
-            updt = update(
-                self.tables.passive
-            ).where(whereclause).values(upsert)
-            self.db.execute(updt)
+        ).bindparams(*(bindparam(col, type_=table.columns[col].type)
+                       for col in columns))
+        return self._upsert
+
+    def insert_or_update_bulk(self, specs, getinfos=None,
+                              separated_timestamps=True):
+        """Like `.insert_or_update()`, but `specs` parameter has to be an
+        iterable of `(timestamp, spec)` (if `separated_timestamps` is
+        True) or `spec` (if it is False) values.
+
+        The records are written using one executemany() call of an
+        upsert statement (INSERT ... ON CONFLICT DO UPDATE, requires
+        SQLite >= 3.24) per transaction of `config.SQLITE_BATCH_SIZE`
+        records. The database is switched to the WAL journal mode.
+
+        """
+        with self.db.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            batch = []
+            for spec in specs:
+                if separated_timestamps:
+                    timestamp, spec = spec
+                    lastseen = None
+                else:
+                    timestamp = spec.pop("firstseen", None)
+                    lastseen = spec.pop("lastseen", None)
+                if spec is None:
+                    continue
+                vals = self._spec2values(timestamp or lastseen, spec,
+                                         getinfos=getinfos,
+                                         lastseen=lastseen)
+                vals['addr'] = utils.force_int2ip(vals['addr'])
+                batch.append(vals)
+                if len(batch) >= config.SQLITE_BATCH_SIZE:
+                    with conn.begin():
+                        conn.execute(self._upsert_stmt, batch)
+                    batch = []
+            if batch:
+                with conn.begin():
+                    conn.execute(self._upsert_stmt, batch)
 
     def update_dns_blacklist(self):
         """A specific implementation is required for SQLite because
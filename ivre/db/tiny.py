@@ -58,6 +58,9 @@ class TinyDB(DB):
 
     flt_empty = Query()
     no_limit = None
+    # The whole JSON file is rewritten on each write: with several
+    # writers, the last one wins and the other writes are lost.
+    concurrent_writes = False
 
     def __init__(self, url):
         super(TinyDB, self).__init__()
@@ -1888,6 +1891,49 @@ class TinyDBPassive(TinyDB, DBPassive):
     """A Passive-specific DB using TinyDB backend"""
 
     dbname = "passive"
+    # Fields that are not part of a record's identity (see
+    # ._spec_key())
+    nonkey_fields = set(['_id', 'count', 'firstseen', 'lastseen', 'infos'])
+
+    def __init__(self, url):
+        super(TinyDBPassive, self).__init__(url)
+        self._spec_index = None
+        self._buffered = False
+        # pending writes, see .flush()
+        self._pending_updates = {}
+        self._pending_inserts = {}
+
+    def invalidate_cache(self):
+        self.flush()
+        super(TinyDBPassive, self).invalidate_cache()
+        self._spec_index = None
+
+    def init(self):
+        self._pending_updates = {}
+        self._pending_inserts = {}
+        super(TinyDBPassive, self).init()
+        self._spec_index = None
+
+    @classmethod
+    def _spec_key(cls, rec):
+        """Returns the key used to identify `rec` (in its internal form)
+in the index: its sorted (key, value) items, except for the
+`nonkey_fields`.
+
+        """
+        return tuple(sorted((key, value) for key, value in viewitems(rec)
+                            if key not in cls.nonkey_fields))
+
+    @property
+    def spec_index(self):
+        """A {spec key: doc_id} dict, built from the database content when
+first used and kept in sync by .insert() and .insert_or_update().
+
+        """
+        if self._spec_index is None:
+            self._spec_index = dict((self._spec_key(rec), rec.doc_id)
+                                    for rec in self.db.all())
+        return self._spec_index
 
     @classmethod
     def rec2internal(cls, rec):
@@ -1962,12 +2008,13 @@ None) is returned.
         if getinfos is not None:
             spec.update(getinfos(spec))
         spec = self.rec2internal(spec)
-        self.db.insert(spec)
+        doc_id = self.db.insert(spec)
+        if self._spec_index is not None:
+            self._spec_index.setdefault(self._spec_key(spec), doc_id)
 
     def insert_or_update(self, timestamp, spec, getinfos=None, lastseen=None):
         if spec is None:
             return
-        q = Query()
         orig = deepcopy(spec)
         spec = self.rec2internal(spec)
         try:
@@ -1975,8 +2022,6 @@ None) is returned.
         except KeyError:
             pass
         count = spec.pop("count", 1)
-        spec_cond = self.flt_and(*(getattr(q, key) == value
-                                   for key, value in viewitems(spec)))
         if isinstance(timestamp, datetime):
             timestamp = utils.datetime2timestamp(timestamp)
         elif isinstance(timestamp, basestring):
@@ -1987,27 +2032,77 @@ None) is returned.
             lastseen = utils.datetime2timestamp(
                 utils.all2datetime(lastseen)
             )
-        current = self.get_one(spec_cond, fields=[])
-        if current is not None:
-            self.db.update(op_update(count, timestamp, lastseen or timestamp),
-                           doc_ids=[current.doc_id])
+        lastseen = lastseen or timestamp
+        key = self._spec_key(spec)
+        if key in self._pending_inserts:
+            op_update(count, timestamp, lastseen)(self._pending_inserts[key])
+        elif key in self.spec_index:
+            op_update(count, timestamp, lastseen)(
+                self._pending_updates.setdefault(self.spec_index[key], {})
+            )
         else:
             doc = dict(spec, count=count, firstseen=timestamp,
-                       lastseen=lastseen or timestamp)
+                       lastseen=lastseen)
             if getinfos is not None:
                 orig.update(getinfos(orig))
                 try:
                     doc['infos'] = orig['infos']
                 except KeyError:
                     pass
-                # upsert() won't handle operations
-            self.db.upsert(doc, spec_cond)
+            self._pending_inserts[key] = doc
+        if not self._buffered or (
+                len(self._pending_updates) + len(self._pending_inserts) >=
+                config.TINYDB_BATCH_SIZE
+        ):
+            self.flush()
+
+    def insert_or_update_bulk(self, specs, getinfos=None,
+                              separated_timestamps=True):
+        """Like `.insert_or_update()`, but `specs` parameter has to be an
+        iterable of (timestamp, spec) values.
+
+        The records are written to the database file once every
+        `config.TINYDB_BATCH_SIZE` records, rather than once per
+        record.
+
+        """
+        self._buffered = True
+        try:
+            super(TinyDBPassive, self).insert_or_update_bulk(
+                specs, getinfos=getinfos,
+                separated_timestamps=separated_timestamps,
+            )
+        finally:
+            self._buffered = False
+            self.flush()
+
+    def flush(self):
+        """Writes the pending updates and inserts (if any) to the
+database, using one write for all the updates and one for all the
+inserts.
+
+        """
+        if self._pending_updates:
+            updates, self._pending_updates = self._pending_updates, {}
+
+            def _update(doc):
+                update = updates[doc.doc_id]
+                op_update(update['count'], update.get('firstseen'),
+                          update.get('lastseen'))(doc)
+            self.db.update(_update, doc_ids=list(updates))
+        if self._pending_inserts:
+            inserts, self._pending_inserts = self._pending_inserts, {}
+            keys, docs = zip(*viewitems(inserts))
+            self.spec_index.update(zip(keys,
+                                       self.db.insert_multiple(docs)))
 
     def remove(self, spec_or_id):
+        self.flush()
         if isinstance(spec_or_id, int_types):
             self.db.remove(doc_ids=[spec_or_id])
         else:
             self.db.remove(cond=spec_or_id)
+        self._spec_index = None
 
     def topvalues(self, field, flt=None, distinct=True, topnbr=10, sort=None,
                   limit=None, skip=None, least=False, aggrflt=None,
@@ -28,9 +28,14 @@ information about IP addresses (mostly from Maxmind GeoIP files).
 
 
 from __future__ import print_function
+from array import array
+from bisect import bisect_right
 import codecs
 import csv
-import os.path
+import heapq
+import json
+import os
+import struct
 import sys
 import tarfile
 try:
@@ -41,7 +46,7 @@ import zipfile
 
 
 from builtins import range
-from future.utils import viewitems, viewvalues
+from future.utils import PY3, viewitems
 
 
 from ivre import VERSION, utils, config
@@ -222,103 +227,160 @@ def locids_by_region(country_code, reg_code):
 
 class IPRanges(object):
 
+    """A set of IP address ranges, that can be used as a sequence of
+IP addresses (as integers): the nth address of the set is accessed in
+O(log(number of ranges)) thanks to a binary search.
+
+The ranges are stored in two parallel columns (`array` objects when
+the values fit, lists otherwise): the first address of each range, and
+the index, in the whole set, of that address (i.e., the cumulative
+number of addresses in the previous ranges).
+
+    """
+
     def __init__(self, ranges=None):
         """ranges must be given in the "correct" order *and* not
         overlap.
 
         """
-        self.ranges = {}
+        self.starts = array('I')
+        self.offsets = array('I')
         self.length = 0
         if ranges is not None:
             for rnge in ranges:
                 self.append(*rnge)
 
+    def __setstate__(self, state):
+        if 'ranges' in state:
+            # Objects pickled by previous versions (e.g., targets
+            # stored in the agents database) used a {offset: (start,
+            # length)} dict.
+            ranges = state.pop('ranges')
+            self.__init__(
+                (start, start + length - 1)
+                for _, (start, length) in sorted(viewitems(ranges))
+            )
+            return
+        self.__dict__.update(state)
+
+    @staticmethod
+    def _append(column, value):
+        """Appends `value` to `column` and returns the column, which is
+converted to a list when `value` does not fit in the array.
+
+        """
+        try:
+            column.append(value)
+        except OverflowError:
+            column = list(column)
+            column.append(value)
+        return column
+
     def append(self, start, stop):
-        length = stop - start + 1
-        self.ranges[self.length] = (start, length)
-        self.length += int(length)  # in case it's a long
+        self.starts = self._append(self.starts, start)
+        self.offsets = self._append(self.offsets, self.length)
+        self.length += int(stop - start + 1)  # in case it's a long
 
     def union(self, *others):
+        """Returns a new IPRanges object with the addresses in self or in
+any of `others`; overlapping and adjacent ranges are merged.
+
+        """
         res = IPRanges()
-        gens = [self.iter_int_ranges()] + [o.iter_int_ranges() for o in others]
-        curs = []
-        # We cannot use a `for itr in itrs` loop here because itrs is
-        # modified in the loop.
-        i = 0
-        while i < len(gens):
-            try:
-                curs.append(list(next(gens[i])))
-            except StopIteration:
-                # We need to remove the corresponding generator from
-                # gens, which happens to be the n-th where n is the
-                # current length of next_recs.
-                del gens[len(curs)]  # Do not increment i here
+        cur_start = cur_stop = None
+        for start, stop in heapq.merge(self.iter_int_ranges(),
+                                       *(o.iter_int_ranges() for o in others)):
+            if cur_start is None:
+                cur_start, cur_stop = start, stop
+            elif start <= cur_stop + 1:
+                cur_stop = max(cur_stop, stop)
             else:
-                i += 1
-        while curs:
-            cur_range = min(curs, key=lambda k: k[0])
-            while True:
-                # We cannot use a `for i in range(len(itrs))` loop because
-                # itrs is modified in the loop.
-                i = 0
-                cur_range_modified = False
-                while i < len(gens):
-                    needs_continue = False
-                    while curs[i][1] < cur_range[1]:
-                        try:
-                            curs[i] = list(next(gens[i]))
-                        except StopIteration:
-                            del gens[i]
-                            del curs[i]
-                            needs_continue = True
-                            break  # Do not increment i
-                        i += 1
-                    if needs_continue:
-                        continue
-                    if curs[i][0] <= cur_range[1] + 1:
-                        cur_range[1] = curs[i][1]
-                        cur_range_modified = True
-                        try:
-                            curs[i] = list(next(gens[i]))
-                        except StopIteration:
-                            del gens[i]
-                            del curs[i]
-                            continue  # Do not increment i
-                    i += 1
-                if not cur_range_modified:
+                res.append(cur_start, cur_stop)
+                cur_start, cur_stop = start, stop
+        if cur_start is not None:
+            res.append(cur_start, cur_stop)
+        return res
+
+    def difference(self, *others):
+        """Returns a new IPRanges object with the addresses in self but
+not in any of `others`, using a single sweep over the sorted ranges.
+
+        """
+        res = IPRanges()
+        excluded = IPRanges().union(*others).iter_int_ranges()
+        cur = next(excluded, None)
+        for start, stop in self.iter_int_ranges():
+            while cur is not None and cur[1] < start:
+                cur = next(excluded, None)
+            while cur is not None and cur[0] <= stop:
+                if cur[0] > start:
+                    res.append(start, cur[0] - 1)
+                start = cur[1] + 1
+                if cur[1] > stop:
+                    break
+                cur = next(excluded, None)
+            if start <= stop:
+                res.append(start, stop)
+        return res
+
+    def intersection(self, *others):
+        """Returns a new IPRanges object with the addresses in self and in
+all of `others`, using a single sweep over the sorted ranges for each
+of `others`.
+
+        """
+        res = self
+        for other in others:
+            res = res._intersection(other)
+        if res is self:
+            return IPRanges(self.iter_int_ranges())
+        return res
+
+    def _intersection(self, other):
+        res = IPRanges()
+        ranges = other.iter_int_ranges()
+        cur = next(ranges, None)
+        for start, stop in self.iter_int_ranges():
+            while cur is not None and cur[0] <= stop:
+                if cur[1] >= start:
+                    res.append(max(start, cur[0]), min(stop, cur[1]))
+                if cur[1] > stop:
                     break
-            res.append(*cur_range)
+                cur = next(ranges, None)
         return res
 
     def iter_int_ranges(self):
-        for start, length in sorted(viewvalues(self.ranges)):
-            yield start, start + length - 1
+        starts, offsets = self.starts, self.offsets
+        for i in range(len(starts)):
+            try:
+                length = offsets[i + 1] - offsets[i]
+            except IndexError:
+                length = self.length - offsets[i]
+            yield starts[i], starts[i] + length - 1
 
     def iter_ranges(self):
-        for start, length in sorted(viewvalues(self.ranges)):
-            yield utils.int2ip(start), utils.int2ip(start + length - 1)
+        for start, stop in self.iter_int_ranges():
+            yield utils.int2ip(start), utils.int2ip(stop)
 
     def iter_nets(self):
-        for start, length in sorted(viewvalues(self.ranges)):
+        for start, stop in self.iter_int_ranges():
             for net in utils.range2nets((utils.int2ip(start),
-                                         utils.int2ip(start + length - 1))):
+                                         utils.int2ip(stop))):
                 yield net
 
     def iter_addrs(self):
-        for start, length in sorted(viewvalues(self.ranges)):
-            for val in range(start, start + length):
+        for start, stop in self.iter_int_ranges():
+            for val in range(start, stop + 1):
                 yield utils.int2ip(val)
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, item):
-        rangeindex = max(k for k in self.ranges if k <= item)
-        item -= rangeindex
-        rnge = self.ranges[rangeindex]
-        if item < rnge[1]:
-            return rnge[0] + item
-        raise IndexError("index out of range")
+        if not 0 <= item < self.length:
+            raise IndexError("index out of range")
+        rangeindex = bisect_right(self.offsets, item) - 1
+        return self.starts[rangeindex] + item - self.offsets[rangeindex]
 
 
 def _get_by_data(datafile, condition):
@@ -336,42 +398,170 @@ def get_ranges_by_data(datafile, condition):
     return rnge
 
 
+# For each CSV dump (created by `ivre ipdata --import-all`), the
+# ranges indexes to create: {name: function returning the key of a
+# (split) line}.
+RANGES_INDEXES = {
+    'GeoLite2-ASN.dump-IPv4.csv': {
+        'asnum': lambda line: line[2],
+    },
+    'GeoLite2-Country.dump-IPv4.csv': {
+        'country': lambda line: line[2],
+    },
+    'GeoLite2-City.dump-IPv4.csv': {
+        'city': lambda line: '%s,%s' % (line[2], line[4]),
+        'region': lambda line: '%s,%s' % (line[2], line[3]),
+        'location': lambda line: line[5],
+    },
+}
+
+
+class RangesIndex(object):
+
+    """Ranges of a CSV dump, partitioned by key (e.g., country code or
+AS number), so that the ranges for a given key can be read without
+reading (and parsing) the whole CSV file.
+
+The file contains, after a header (magic, size of the directory):
+
+  - the directory, JSON-encoded: {key: [position, count]}.
+
+  - for each key, the first and last addresses of its ranges
+    (sorted), as unsigned 32-bit integers in the native byte order,
+    which is part of the magic value.
+
+    """
+
+    MAGIC = b'IVREKEY' + (b'<' if sys.byteorder == 'little' else b'>')
+    HEADER = struct.Struct('=8sQ')
+
+    def __init__(self, datafile, name):
+        self.datafile = os.path.join(config.GEOIP_PATH, datafile)
+        self.path = '%s.%s.idx' % (self.datafile[:-4], name)
+        self.keyfunc = RANGES_INDEXES[datafile][name]
+
+    def is_valid(self):
+        """Returns True when the index exists and is newer than the CSV
+dump.
+
+        """
+        return utils.is_newer(self.path, self.datafile)
+
+    @classmethod
+    def build_all(cls, datafile, force=False):
+        """Creates the ranges indexes of `datafile` (see
+`RANGES_INDEXES`), reading the CSV dump only once. Indexes newer than
+the dump are skipped unless `force` is True.
+
+        """
+        indexes = [cls(datafile, name) for name in RANGES_INDEXES[datafile]]
+        if not force:
+            indexes = [index for index in indexes if not index.is_valid()]
+        if not indexes:
+            utils.LOGGER.info('Skipping %r since ranges indexes are newer',
+                              datafile)
+            return
+        ranges = [{} for _ in indexes]
+        with open(indexes[0].datafile) as fdesc:
+            for line in fdesc:
+                line = line[:-1].split(',')
+                rnge = (int(line[0]), int(line[1]))
+                for index, values in zip(indexes, ranges):
+                    values.setdefault(index.keyfunc(line),
+                                      array('I')).extend(rnge)
+        for index, values in zip(indexes, ranges):
+            utils.LOGGER.info('Indexing %r to %r', datafile,
+                              os.path.basename(index.path))
+            index.write(values)
+
+    def write(self, ranges):
+        """Writes the index from `ranges`, a {key: array('I', [start1,
+stop1, start2, stop2, ...])} dict.
+
+        """
+        directory = {}
+        pos = 0
+        for key in sorted(ranges):
+            count = len(ranges[key]) // 2
+            directory[key] = [pos, count]
+            pos += count
+        directory = json.dumps(directory, sort_keys=True).encode()
+        # The index may be in use by other processes: write a new file
+        # and replace the old one.
+        with open(self.path + '.tmp', 'wb') as fdesc:
+            fdesc.write(self.HEADER.pack(self.MAGIC, len(directory)))
+            fdesc.write(directory)
+            for key in sorted(ranges):
+                fdesc.write(ranges[key].tobytes() if PY3 else
+                            ranges[key].tostring())
+        getattr(os, 'replace', os.rename)(self.path + '.tmp', self.path)
+
+    def get_ranges(self, key):
+        """Returns an IPRanges object with the ranges for `key`."""
+        with open(self.path, 'rb') as fdesc:
+            magic, dirsize = self.HEADER.unpack(
+                fdesc.read(self.HEADER.size)
+            )
+            if magic != self.MAGIC:
+                raise ValueError('Invalid ranges index file %r' % self.path)
+            directory = json.loads(fdesc.read(dirsize).decode())
+            try:
+                pos, count = directory[key]
+            except KeyError:
+                return IPRanges()
+            fdesc.seek(self.HEADER.size + dirsize + 8 * pos)
+            values = array('I')
+            values.fromfile(fdesc, 2 * count)
+        return IPRanges(zip(values[::2], values[1::2]))
+
+
+def get_ranges_by_key(datafile, name, key):
+    """Returns an IPRanges object with the ranges of `datafile` for
+which the key `name` (see `RANGES_INDEXES`) is `key`.
+
+The ranges index is used when it is available; otherwise, the whole
+CSV dump is read.
+
+    """
+    index = RangesIndex(datafile, name)
+    if index.is_valid():
+        try:
+            return index.get_ranges(key)
+        except (IOError, ValueError, struct.error, EOFError):
+            utils.LOGGER.warning('Cannot use ranges index %r', index.path,
+                                 exc_info=True)
+    return get_ranges_by_data(datafile,
+                              lambda line: index.keyfunc(line) == key)
+
+
 def get_ranges_by_country(code):
-    return get_ranges_by_data(
-        "GeoLite2-Country.dump-IPv4.csv",
-        lambda line: line[2] == code,
-    )
+    return get_ranges_by_key("GeoLite2-Country.dump-IPv4.csv", 'country',
+                             code)
 
 
 def get_ranges_by_location(locid):
-    return get_ranges_by_data(
-        'GeoLite2-City.dump-IPv4.csv',
-        lambda line: line[5] == str(locid)
-    )
+    return get_ranges_by_key('GeoLite2-City.dump-IPv4.csv', 'location',
+                             str(locid))
 
 
 def get_ranges_by_city(country_code, city):
-    return get_ranges_by_data(
-        'GeoLite2-City.dump-IPv4.csv',
-        lambda line: line[2] == country_code and
-        line[4] == utils.encode_b64(
-            (city or "").encode('utf-8')
-        ).decode('utf-8'),
+    return get_ranges_by_key(
+        'GeoLite2-City.dump-IPv4.csv', 'city',
+        '%s,%s' % (country_code,
+                   utils.encode_b64((city or "").encode('utf-8')).decode(
+                       'utf-8'
+                   )),
     )
 
 
 def get_ranges_by_region(country_code, reg_code):
-    return get_ranges_by_data(
-        'GeoLite2-City.dump-IPv4.csv',
-        lambda line: line[2] == country_code and line[3] == reg_code,
-    )
+    return get_ranges_by_key('GeoLite2-City.dump-IPv4.csv', 'region',
+                             '%s,%s' % (country_code, reg_code))
 
 
 def get_ranges_by_asnum(asnum):
-    return get_ranges_by_data(
-        "GeoLite2-ASN.dump-IPv4.csv",
-        lambda line: line[2] == str(asnum),
-    )
+    return get_ranges_by_key("GeoLite2-ASN.dump-IPv4.csv", 'asnum',
+                             str(asnum))
 
 
 def get_routable_ranges():
@@ -26,6 +26,16 @@ module that might be useful to any other sub-module or script.
 """
 
 
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
+import random
+
+
+from ivre import utils
+
+
 def genprimes():
     '''Yields the sequence of prime numbers via the Sieve of Eratosthenes.
 
@@ -45,14 +55,177 @@ http://code.activestate.com/recipes/117119/
         q += 1
 
 
-def factors(n):
-    '''Yields the prime factors of the integer n.'''
+def genprimes_below(limit):
+    '''Returns the list of the prime numbers lower than limit.'''
+    primes = []
     for p in genprimes():
-        while n != 1 and n % p == 0:
-            yield p
-            n //= p
-        if n == 1:
-            break
+        if p >= limit:
+            return primes
+        primes.append(p)
+
+
+SMALL_PRIMES = genprimes_below(1000)
+# Miller-Rabin is deterministic with these bases for n <
+# 3317044064679887385961981 (> 2 ** 81); for larger numbers, the
+# probability of a wrong answer is lower than 4 ** -len(MR_BASES).
+MR_BASES = SMALL_PRIMES[:24]
+
+
+def is_prime(n):
+    '''Returns True when the integer n is a prime number (Miller-Rabin
+primality test).
+
+    '''
+    if n < 2:
+        return False
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for a in MR_BASES:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _pollard_rho(n, max_steps=None):
+    '''Returns a non-trivial factor of the odd composite integer n
+(Pollard's rho algorithm, Brent's variant), or None when none has been
+found after max_steps iterations (if max_steps is not None).
+
+    '''
+    rand = random.Random(n)
+    steps = 0
+    while True:
+        y, c = rand.randrange(1, n), rand.randrange(1, n)
+        step = 128
+        g = r = q = 1
+        while g == 1:
+            if max_steps is not None and steps > max_steps:
+                return None
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(step, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += step
+            steps += 2 * r
+            r *= 2
+        if g == n:
+            # backtrack from the last gcd() computation
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+        if g != n:
+            return g
+
+
+def _bit_length(n):
+    """Same as n.bit_length() for n >= 1 (int.bit_length() does not
+exist in Python 2.6).
+
+    """
+    return len(bin(n)) - 2
+
+
+def _iroot(n, k):
+    '''Returns the integer k-th root of the integer n >= 1 (the largest
+integer x such that x ** k <= n).
+
+    '''
+    x = 1 << -(-_bit_length(n) // k)  # greater than the root
+    while True:
+        y = ((k - 1) * x + n // x ** (k - 1)) // k
+        if y >= x:
+            return x
+        x = y
+
+
+def _factorize(n, max_steps=None):
+    result = []
+    for p in SMALL_PRIMES:
         if p * p > n:
-            yield n
             break
+        while n % p == 0:
+            result.append(p)
+            n //= p
+    if n == 1:
+        return result
+    todo = [n]
+    while todo:
+        n = todo.pop()
+        if n < SMALL_PRIMES[-1] ** 2 or is_prime(n):
+            result.append(n)
+            continue
+        # Pollard's rho is slow on perfect powers; n has no prime
+        # factor lower than 1000 (> 2 ** 9)
+        for k in range(2, _bit_length(n) // 9 + 1):
+            root = _iroot(n, k)
+            if root ** k == n:
+                todo.extend([root] * k)
+                break
+        else:
+            root = None
+        if root is not None:
+            continue
+        factor = _pollard_rho(n, max_steps=max_steps)
+        if factor is None:
+            result.append(n)
+            continue
+        todo.extend([factor, n // factor])
+    return sorted(result)
+
+
+FACTORS_CACHE_SIZE = 1024
+_FACTORS_CACHE = utils.OrderedDict()
+
+
+def factorize(n, max_steps=None):
+    '''Returns the prime factors of the integer n (n >= 1), in
+ascending order and with multiplicity, as a tuple.
+
+Small factors are found by trial division, then Miller-Rabin and
+Pollard's rho are used, so that most numbers up to 2 ** 128 are
+factored in milliseconds; numbers with two (or more) large prime
+factors may take much longer. When max_steps is not None, the factors
+that Pollard's rho cannot split within max_steps iterations are
+returned as is (and hence may not be prime), which bounds the time
+needed.
+
+The results are cached (at most FACTORS_CACHE_SIZE entries), since
+the same numbers (e.g., the number of addresses of a target) are often
+factored several times.
+
+    '''
+    key = (n, max_steps)
+    try:
+        return _FACTORS_CACHE[key]
+    except KeyError:
+        pass
+    result = tuple(_factorize(n, max_steps=max_steps))
+    if len(_FACTORS_CACHE) >= FACTORS_CACHE_SIZE:
+        _FACTORS_CACHE.popitem(last=False)
+    _FACTORS_CACHE[key] = result
+    return result
+
+
+def factors(n):
+    '''Yields the prime factors of the integer n.'''
+    for p in factorize(n):
+        yield p
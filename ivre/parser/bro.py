@@ -18,7 +18,9 @@
 
 """Support for Bro log files"""
 
+from collections import deque
 import datetime
+from itertools import islice
 import re
 
 
@@ -33,13 +35,20 @@ CONTAINER_TYPE = re.compile(b"^(table|set|vector)\\[([a-z]+)\\]$")
 
 
 class BroFile(Parser):
-    """Bro log generator"""
+    """Bro log generator
+
+    A converter is compiled for each column when the header has been
+    read, so that the type of the values is not checked again for
+    each line. When `columns` is not None, only the fields whose
+    (output) names are listed are converted and returned.
+
+    """
 
     int_types = set([b"port", b"count"])
     float_types = set([b"interval"])
     time_types = set([b"time"])
 
-    def __init__(self, fname):
+    def __init__(self, fname, columns=None):
         self.sep = b" "  # b"\t"
         self.set_sep = b","
         self.empty_field = b"(empty)"
@@ -47,7 +56,9 @@ class BroFile(Parser):
         self.fields = []
         self.types = []
         self.path = None
-        self.nextlines = []
+        self.nextlines = deque()
+        self.columns = None if columns is None else set(columns)
+        self.converters = None
         super(BroFile, self).__init__(fname)
         for line in self.fdesc:
             line = line.strip()
@@ -57,10 +68,64 @@ class BroFile(Parser):
             self.parse_header_line(line)
 
     def __next__(self):
-        return self.parse_line(self.nextlines.pop(0)
+        return self.parse_line(self.nextlines.popleft()
                                if self.nextlines else
                                next(self.fdesc).strip())
 
+    def read_records(self, count):
+        """Returns a list of (at most) `count` records; the list is empty
+        when the end of the file has been reached.
+
+        """
+        return list(islice(self, count))
+
+    header_keys = ["sep", "set_sep", "empty_field", "unset_field", "fields",
+                   "types", "path"]
+
+    @property
+    def header(self):
+        """The values set by the header lines (see `.from_header()`)."""
+        return dict((key, getattr(self, key)) for key in self.header_keys)
+
+    @classmethod
+    def from_header(cls, header, columns=None):
+        """Returns a parser without any file, that can parse (using
+        `.parse_line()`) the data lines of a file whose header has been
+        read by another parser (e.g., in another process).
+
+        """
+        parser = cls.__new__(cls)
+        parser.nextlines = deque()
+        parser.columns = None if columns is None else set(columns)
+        parser.converters = None
+        parser.__dict__.update(header)
+        return parser
+
+    def iter_chunks(self, size):
+        """Yields (header, lines) tuples, where `lines` is a list of (at
+        most `size`) unparsed data lines and `header` the value of
+        `.header` to parse them. The header lines found in the file are
+        parsed, and never part of `lines`.
+
+        """
+        lines, self.nextlines = list(self.nextlines), deque()
+        header = self.header
+        for line in self.fdesc:
+            line = line.strip()
+            if line.startswith(b'#'):
+                if lines:
+                    yield header, lines
+                    lines = []
+                self.parse_header_line(line)
+                header = self.header
+                continue
+            lines.append(line)
+            if len(lines) >= size:
+                yield header, lines
+                lines = []
+        if lines:
+            yield header, lines
+
     def parse_header_line(self, line):
         if not line:
             return
@@ -78,6 +143,8 @@ class BroFile(Parser):
 
         directive = keyval[0]
         arg = keyval[1]
+        # the converters depend on the header values
+        self.converters = None
 
         if directive == b"separator":
             self.sep = decode_hex(arg[2:]) if arg.startswith(b'\\x') else arg
@@ -100,13 +167,67 @@ class BroFile(Parser):
         if line.startswith(b'#'):
             self.parse_header_line(line)
             return next(self)
-        res = {}
+        if self.converters is None:
+            self.converters = self.compile_converters()
         fields = line.split(self.sep)
+        if len(fields) < len(self.fields):
+            return dict((name, converter(fields[i]))
+                        for i, name, converter in self.converters
+                        if i < len(fields))
+        return dict((name, converter(fields[i]))
+                    for i, name, converter in self.converters)
+
+    def compile_converters(self):
+        """Returns a tuple of (index, name, converter) tuples, one for
+        each column to parse, according to the header values.
+
+        """
+        return tuple(
+            (i, name, self.get_converter(typ))
+            for i, (name, typ) in enumerate(
+                (name.replace(b".", b"_").decode(), typ)
+                for name, typ in zip(self.fields, self.types)
+            )
+            if self.columns is None or name in self.columns
+        )
+
+    def get_converter(self, typ):
+        """Returns a function that converts a value of type `typ`, like
+        `.fix_value()` does.
 
-        for field, name, typ in zip(fields, self.fields, self.types):
-            name = name.replace(b".", b"_").decode()
-            res[name] = self.fix_value(field, typ)
-        return res
+        """
+        unset_field = self.unset_field
+        empty_field = self.empty_field
+        if typ == b"bool":
+            return lambda val: None if val == unset_field else val == b"T"
+        container_type = CONTAINER_TYPE.search(typ)
+        if container_type is not None:
+            set_sep = self.set_sep
+            elt_converter = self.get_converter(container_type.groups()[1])
+
+            def converter(val):
+                if val == unset_field:
+                    return None
+                if val == empty_field:
+                    return []
+                return [elt_converter(x) for x in val.split(set_sep)]
+            return converter
+        if typ in self.int_types:
+            function = int
+        elif typ in self.float_types:
+            function = float
+        elif typ in self.time_types:
+            def function(val):
+                return datetime.datetime.fromtimestamp(float(val))
+        else:
+            def converter(val):
+                if val == unset_field:
+                    return None
+                if val == empty_field:
+                    return ""
+                return val.decode()
+            return converter
+        return lambda val: None if val == unset_field else function(val)
 
     def fix_value(self, val, typ):
         if val == self.unset_field:
@@ -25,9 +25,12 @@ This sub-module contains functions used for passive recon.
 """
 
 
+from bisect import bisect_right
+from copy import deepcopy
 from datetime import datetime
 import hashlib
 import re
+import shelve
 import struct
 
 
@@ -217,14 +220,66 @@ def _split_digest_auth(data):
     return values
 
 
+def compile_ignorenets(ignorenets):
+    """Compiles the IGNORENETS rules, a {recontype: [(start, stop),
+    ...]} dict where `start` and `stop` are IP addresses (as strings
+    or integers), to a {recontype: (starts, stops)} dict.
+
+    For each recontype, the ranges are converted to integers, sorted
+    and merged (overlapping and adjacent ranges are combined), so that
+    `starts` and `stops` are two sorted lists that can be looked up
+    using `bisect` (see `_is_ignored()`).
+
+    """
+    result = {}
+    for recontype, ranges in viewitems(ignorenets):
+        starts, stops = [], []
+        for start, stop in sorted((utils.force_ip2int(start),
+                                   utils.force_ip2int(stop))
+                                  for start, stop in ranges):
+            if start > stop:
+                # empty range, would never match
+                continue
+            if stops and start <= stops[-1] + 1:
+                stops[-1] = max(stops[-1], stop)
+            else:
+                starts.append(start)
+                stops.append(stop)
+        if starts:
+            result[recontype] = (starts, stops)
+    return result
+
+
+def compile_neverignore(neverignore):
+    """Compiles the NEVERIGNORE rules, a {recontype: [source, ...]}
+    dict, to a {recontype: frozenset([source, ...])} dict.
+
+    """
+    return dict((recontype, frozenset(sources))
+                for recontype, sources in viewitems(neverignore))
+
+
+def _is_ignored(addr, ranges):
+    """Returns True when `addr` belongs to one of the `ranges`, as
+    returned (for one recontype) by `compile_ignorenets()`.
+
+    """
+    starts, stops = ranges
+    addr = utils.force_ip2int(addr)
+    index = bisect_right(starts, addr) - 1
+    return index >= 0 and addr <= stops[index]
+
+
 def _prepare_rec(spec, ignorenets, neverignore):
     # First of all, let's see if we are supposed to ignore this spec,
-    # and if so, do so.
-    if 'addr' in spec and \
-       spec.get('source') not in neverignore.get(spec['recontype'], []):
-        for start, stop in ignorenets.get(spec['recontype'], ()):
-            if start <= utils.force_ip2int(spec['addr']) <= stop:
-                return None
+    # and if so, do so. `ignorenets` and `neverignore` must have been
+    # compiled using compile_ignorenets() and compile_neverignore().
+    if 'addr' in spec:
+        ranges = ignorenets.get(spec['recontype'])
+        if ranges is not None and \
+           spec.get('source') not in neverignore.get(spec['recontype'], ()) \
+           and _is_ignored(spec['addr'], ranges):
+            return None
     # Then, let's clean up the records.
     # Change Symantec's random user agents (matching SYMANTEC_UA) to
     # the constant string 'SymantecRandomUserAgent'.
@@ -419,17 +474,27 @@ def _getinfos_dns_blacklist(spec):
     return res
 
 
+def _getinfos_sslsrv_function(source):
+    """Returns the source specific function for SSL_SERVER recontype
+records, or None.
+
+    """
+    if source == 'cert':
+        return _getinfos_cert
+    if source.startswith('ja3-'):
+        return _getinfos_ja3
+    return None
+
+
 def _getinfos_sslsrv(spec):
     """Calls a source specific function for SSL_SERVER recontype
 records.
 
     """
-    source = spec.get('source')
-    if source == 'cert':
-        return _getinfos_cert(spec)
-    if source.startswith('ja3-'):
-        return _getinfos_ja3(spec)
-    return {}
+    function = _getinfos_sslsrv_function(spec.get('source'))
+    if function is None:
+        return {}
+    return function(spec)
 
 
 def _getinfos_cert(spec):
@@ -524,14 +589,118 @@ _GETINFOS_FUNCTIONS = {
 }
 
 
+# The functions whose result only depends on the "recontype",
+# "source" and "value" fields of the spec: their results are cached
+# by getinfos()
+_GETINFOS_CACHEABLE = set([
+    _getinfos_http_client_authorization,
+    _getinfos_http_server,
+    _getinfos_cert,
+    _getinfos_tcp_srv_banner,
+    _getinfos_ssh_server,
+    _getinfos_ssh_hostkey,
+])
+# {(recontype, source, sha1(value)): result}, the least recently used
+# first
+_GETINFOS_CACHE = utils.OrderedDict()
+_GETINFOS_CACHE_STATS = {'hits': 0, 'spill_hits': 0, 'misses': 0}
+_GETINFOS_CACHE_SPILL = []
+
+
+def _getinfos_cache_spill():
+    """Returns the persistent cache (a `shelve` object opened the first
+    time it is needed), or None when config.PASSIVE_GETINFOS_CACHE_PATH
+    is not set.
+
+    """
+    if not _GETINFOS_CACHE_SPILL:
+        if config.PASSIVE_GETINFOS_CACHE_PATH is None:
+            _GETINFOS_CACHE_SPILL.append(None)
+        else:
+            _GETINFOS_CACHE_SPILL.append(
+                shelve.open(config.PASSIVE_GETINFOS_CACHE_PATH)
+            )
+    return _GETINFOS_CACHE_SPILL[0]
+
+
+def getinfos_cache_stats():
+    """Returns the statistics of the cache used by getinfos(), as a
+    dict: "hits" (found in memory), "spill_hits" (found in the
+    persistent cache), "misses", "size" (number of entries in memory)
+    and "hit_rate".
+
+    """
+    res = dict(_GETINFOS_CACHE_STATS, size=len(_GETINFOS_CACHE))
+    total = res['hits'] + res['spill_hits'] + res['misses']
+    res['hit_rate'] = (
+        float(res['hits'] + res['spill_hits']) / total if total else 0.
+    )
+    return res
+
+
+def getinfos_cache_clear():
+    """Empties the in-memory cache used by getinfos(), resets its
+    statistics and closes the persistent cache (if any).
+
+    """
+    _GETINFOS_CACHE.clear()
+    for key in _GETINFOS_CACHE_STATS:
+        _GETINFOS_CACHE_STATS[key] = 0
+    while _GETINFOS_CACHE_SPILL:
+        spill = _GETINFOS_CACHE_SPILL.pop()
+        if spill is not None:
+            spill.close()
+
+
 def getinfos(spec):
     """This functions takes a document from a passive sensor, and
     prepares its 'infos' field (which is not added but returned).
 
+    The results of the functions that only depend on the record's
+    value (certificates, SSH keys, banners, ...) are cached, using a
+    digest of the value as a key: the config.PASSIVE_GETINFOS_CACHE_SIZE
+    most recently used are kept in memory. When
+    config.PASSIVE_GETINFOS_CACHE_PATH is set, they are also stored in
+    (and read from) a `shelve` file, that can be reused by other
+    processes (but not concurrently).
+
     """
     function = _GETINFOS_FUNCTIONS.get(spec.get('recontype'))
     if isinstance(function, dict):
         function = function.get(spec.get('source'))
+    elif function is _getinfos_sslsrv:
+        # resolved here so that the certificates can be cached
+        function = _getinfos_sslsrv_function(spec.get('source'))
     if function is None:
         return {}
-    return function(spec)
+    if (
+            function not in _GETINFOS_CACHEABLE or
+            not config.PASSIVE_GETINFOS_CACHE_SIZE
+    ):
+        return function(spec)
+    value = spec.get('value') or ''
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    key = (spec.get('recontype'), spec.get('source'),
+           hashlib.sha1(value).hexdigest())
+    try:
+        result = _GETINFOS_CACHE.pop(key)
+    except KeyError:
+        spill = _getinfos_cache_spill()
+        spillkey = '%s|%s|%s' % key
+        if spill is not None and spillkey in spill:
+            result = spill[spillkey]
+            _GETINFOS_CACHE_STATS['spill_hits'] += 1
+        else:
+            result = function(spec)
+            _GETINFOS_CACHE_STATS['misses'] += 1
+            if spill is not None:
+                spill[spillkey] = result
+        if len(_GETINFOS_CACHE) >= config.PASSIVE_GETINFOS_CACHE_SIZE:
+            _GETINFOS_CACHE.popitem(last=False)
+    else:
+        _GETINFOS_CACHE_STATS['hits'] += 1
+    _GETINFOS_CACHE[key] = result
+    # the result is modified by the callers (e.g., the sizes of the
+    # values are fixed before insertion)
+    return deepcopy(result)
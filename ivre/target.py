@@ -26,11 +26,13 @@ lists.
 """
 
 
+from array import array
 from functools import reduce
 try:
     from math import gcd
 except ImportError:
     from fractions import gcd
+import mmap
 from operator import add, mul
 import os
 import random
@@ -41,13 +43,18 @@ import tempfile
 
 
 from builtins import object
-from future.utils import viewvalues
+from future.utils import PY3
 from past.builtins import basestring
 
 
 from ivre import utils, geoiputils, mathutils
 
 
+# Maximum number of iterations of Pollard's rho algorithm when
+# factoring the number of addresses of a target (see IterTarget)
+LCG_FACTORIZE_MAX_STEPS = 1 << 16
+
+
 class Target(object):
     """This is the base class for a Target object, which is,
     basically, a set of IP selected according specific criteria
@@ -107,6 +114,82 @@ class Target(object):
     def __add__(self, other):
         return self.union(other)
 
+    def difference(self, *others):
+        """Returns a new Target object with the addresses of this one that
+        are not in any of `others`. The excluded addresses are removed
+        from the ranges (so `len()` is exact and no LCG value is
+        wasted on them).
+
+        `maxnbr` and `state` are kept: they apply to the new Target
+        (e.g., a state saved while iterating the same command line).
+
+        """
+        others = tuple(o for o in others if o)
+        targets = self.targets.difference(*(o.targets for o in others))
+        maxnbr = None
+        if self.maxnbr < self.targetscount:
+            maxnbr = min(self.maxnbr, len(targets))
+        return Target(
+            targets, rand=self.rand, maxnbr=maxnbr, state=self.state,
+            name=' - '.join([self.name] + [o.name for o in others]),
+            categories=self.infos['categories'],
+        )
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def shard(self, k, n, seed=0):
+        """Returns the kth (0 <= k < n) of n disjoint Target objects,
+        whose union contains the addresses of this one (limited to
+        `maxnbr`). Each of them can be iterated and resumed (using its
+        own state) independently, e.g., by different agents.
+
+        The addresses are dealt according to their position in the
+        LCG permutation used by `IterTarget`, given by `state`: when
+        `state` is None, it is derived from `seed`, so that the shards
+        built in different processes, with the same `seed`, are
+        disjoint.
+
+        """
+        if not 0 <= k < n:
+            raise ValueError('k must be between 0 and n - 1')
+        if self.state is None:
+            self.state = IterTarget(self, rand=self.rand,
+                                    rng=random.Random(seed)).getstate()
+        previous, lcg_c, lcg_a, nextcount = self.state
+        count = max(0, -(-(self.maxnbr - nextcount - k) // n))
+        if self.targetscount:
+            # the shard's LCG applies n times this LCG, and its first
+            # value is the (k + 1)th value of this LCG: it starts k + 1
+            # - n steps after it (this LCG has a full period, so
+            # applying it targetscount times is the identity)
+            step_a, step_c = _lcg_power(lcg_a, lcg_c, self.targetscount,
+                                        (k + 1 - n) % self.targetscount)
+            previous = (step_a * previous + step_c) % self.targetscount
+            lcg_a, lcg_c = _lcg_power(lcg_a, lcg_c, self.targetscount, n)
+        return Target(
+            self.targets, rand=self.rand, maxnbr=count,
+            state=(previous, lcg_c, lcg_a, 0),
+            name='%s [%d/%d]' % (self.name, k + 1, n),
+            categories=self.infos['categories'],
+        )
+
+
+def _lcg_power(lcg_a, lcg_c, lcg_m, n):
+    """Returns (a, c) such that applying n times x -> (lcg_a * x +
+    lcg_c) % lcg_m is the same as x -> (a * x + c) % lcg_m.
+
+    """
+    res_a, res_c = 1, 0
+    while n:
+        if n & 1:
+            res_a, res_c = (lcg_a * res_a) % lcg_m, (lcg_a * res_c +
+                                                     lcg_c) % lcg_m
+        lcg_a, lcg_c = (lcg_a * lcg_a) % lcg_m, (lcg_a * lcg_c +
+                                                 lcg_c) % lcg_m
+        n >>= 1
+    return res_a, res_c
+
 
 class IterTarget(object):
     """The iterator object returned by `Target.__iter__()`"""
@@ -114,7 +197,7 @@ class IterTarget(object):
     def __iter__(self):
         return self
 
-    def __init__(self, target, rand=True, state=None):
+    def __init__(self, target, rand=True, state=None, rng=random):
         # see https://fr.wikipedia.org/wiki/Générateur_congruentiel_linéaire
         self.target = target
         self.nextcount = 0
@@ -126,14 +209,18 @@ class IterTarget(object):
             self.nextcount = state[3]
         elif rand and target.targetscount > 1:
             # X_{-1}
-            self.previous = random.randint(0, self.lcg_m - 1)
+            self.previous = rng.randint(0, self.lcg_m - 1)
             # GCD(c, m) == 1
-            self.lcg_c = random.randint(1, self.lcg_m - 1)
+            self.lcg_c = rng.randint(1, self.lcg_m - 1)
             # pylint: disable=deprecated-method
             while gcd(self.lcg_c, self.lcg_m) != 1:
-                self.lcg_c = random.randint(1, self.lcg_m - 1)
-            # a - 1 is divisible by all prime factors of m
-            mfactors = reduce(mul, set(mathutils.factors(self.lcg_m)))
+                self.lcg_c = rng.randint(1, self.lcg_m - 1)
+            # a - 1 is divisible by all prime factors of m; factors
+            # that cannot be split quickly are used as is (a - 1 is
+            # still divisible by their prime factors)
+            mfactors = reduce(mul, set(mathutils.factorize(
+                self.lcg_m, max_steps=LCG_FACTORIZE_MAX_STEPS,
+            )))
             # a - 1 is a multiple of 4 if m is a multiple of 4.
             if self.lcg_m % 4 == 0:
                 mfactors *= 2
@@ -279,6 +366,53 @@ class TargetNetwork(TargetRange):
         )
 
 
+class TargetExcludeFile(Target):
+    """This class can be used to get the IP addresses listed in an
+    exclusion (or opt-out) file, to remove them from another target
+    (see `Target.difference()`).
+
+    Each line contains an IP address, a network (NET/MASK) or a range
+    (START-STOP); comments start with "#". Entries may overlap and do
+    not have to be sorted.
+
+    """
+
+    def __init__(self, filename, categories=None):
+        ranges = []
+        with open(filename) as fdesc:
+            for line in fdesc:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    if '/' in line:
+                        start, stop = utils.net2range(line)
+                    elif '-' in line:
+                        start, stop = (val.strip()
+                                       for val in line.split('-', 1))
+                    else:
+                        start = stop = line
+                    start, stop = utils.ip2int(start), utils.ip2int(stop)
+                    if start > stop:
+                        raise ValueError('empty range')
+                    ranges.append((start, stop))
+                except (ValueError, utils.socket.error):
+                    utils.LOGGER.warning('Invalid exclusion entry %r in %r',
+                                         line, filename)
+        # IPRanges() expects sorted, non-overlapping ranges: merge the
+        # overlapping and adjacent ones
+        merged = []
+        for start, stop in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        super(TargetExcludeFile, self).__init__(
+            geoiputils.IPRanges(ranges=merged),
+            rand=False, name='EXCLUDE-%s' % filename, categories=categories,
+        )
+
+
 class TargetFile(Target):
     """This is a specific `Target`-like object (see `Target`), with
     neither the knowledge of the size of the IP addresses set, nor the
@@ -286,10 +420,15 @@ class TargetFile(Target):
     before it.
 
     Because of this, we cannot iterate the IP addresses in a random
-    order or .union().
+    order or .union(), unless `rand` is True: in that case, an index
+    of the lines (see `TargetFileIndex`) is used to get the nth
+    element, and the IP addresses are iterated in a random order, as
+    with `Target` objects (.union() is still not available).
 
     """
 
+    rand = False
+
     @staticmethod
     def _getaddr(line):
         try:
@@ -297,21 +436,27 @@ class TargetFile(Target):
         except utils.socket.error:
             pass
 
-    def __init__(self, filename, categories=None, maxnbr=None, state=None):
+    def __init__(self, filename, categories=None, maxnbr=None, state=None,
+                 rand=False):
         self.filename = filename
         self.name = 'FILE-%s' % filename
         if categories is None:
             categories = [self.name]
         self.infos = {'categories': categories}
-        with open(filename) as fdesc:
-            i = 0
-            for line in fdesc:
-                try:
-                    self._getaddr(line)
-                    i += 1
-                except utils.socket.error:
-                    pass
-            self.targetscount = i
+        self.rand = rand
+        if rand:
+            self.targets = TargetFileIndex(filename)
+            self.targetscount = len(self.targets)
+        else:
+            with open(filename) as fdesc:
+                i = 0
+                for line in fdesc:
+                    try:
+                        self._getaddr(line)
+                        i += 1
+                    except utils.socket.error:
+                        pass
+                self.targetscount = i
         if maxnbr is None:
             self.maxnbr = self.targetscount
         else:
@@ -319,12 +464,111 @@ class TargetFile(Target):
         self.state = state
 
     def __iter__(self):
+        if self.rand:
+            return IterTarget(self, rand=True, state=self.state)
         return IterTargetFile(self, open(self.filename), state=self.state)
 
+    def shard(self, k, n, seed=0):
+        if not self.rand:
+            raise ValueError('Cannot shard when rand is False')
+        return super(TargetFile, self).shard(k, n, seed=seed)
+
+    def difference(self, *others):
+        raise ValueError('Cannot exclude addresses from a file target')
+
     def close(self):
         pass
 
 
+class TargetFileIndex(object):
+    """The lines of a target file that contain an IP address, as a
+    sequence of IP addresses (as integers) that can be accessed in a
+    random order.
+
+    The offset of each of these lines is stored (as an array of
+    unsigned 64-bit integers, in the native byte order) in an index
+    file created, in one pass, next to the target file and
+    memory-mapped when possible. The index is rebuilt when the target
+    file is newer. When the platform has no array type for 64-bit
+    integers, the offsets are only kept in memory.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = '%s.ivre-offsets' % filename
+        self.load()
+
+    def __getstate__(self):
+        # the index is loaded again when unpickled
+        return {'filename': self.filename, 'path': self.path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+    def load(self):
+        if utils.ARRAY_UINT64 is None:
+            # no array type for 64-bit integers: the offsets are kept
+            # in memory (as a list)
+            self.offsets = self.build()
+            self.fdesc = open(self.filename, 'rb')
+            return
+        if not utils.is_newer(self.path, self.filename):
+            offsets = self.build()
+            try:
+                with open(self.path + '.tmp', 'wb') as fdesc:
+                    offsets.tofile(fdesc)
+                getattr(os, 'replace', os.rename)(self.path + '.tmp',
+                                                  self.path)
+            except (IOError, OSError):
+                utils.LOGGER.warning('Cannot write index %r, keeping it in '
+                                     'memory', self.path, exc_info=True)
+                self.offsets = offsets
+                self.fdesc = open(self.filename, 'rb')
+                return
+        self.fdesc = open(self.filename, 'rb')
+        with open(self.path, 'rb') as fdesc:
+            size = os.fstat(fdesc.fileno()).st_size
+            self.offsets = array(utils.ARRAY_UINT64)
+            if not size:
+                return
+            if not PY3:
+                # Python 2: memoryview.cast() does not exist, read
+                # the data
+                self.offsets.fromfile(fdesc, size // self.offsets.itemsize)
+                return
+            self.offsets = memoryview(
+                mmap.mmap(fdesc.fileno(), 0, access=mmap.ACCESS_READ)
+            ).cast(utils.ARRAY_UINT64)
+
+    def build(self):
+        """Reads the target file and returns the offsets of the lines
+        that contain an IP address.
+
+        """
+        offsets = ([] if utils.ARRAY_UINT64 is None else
+                   array(utils.ARRAY_UINT64))
+        pos = 0
+        with open(self.filename, 'rb') as fdesc:
+            for line in fdesc:
+                if TargetFile._getaddr(
+                        line.decode('utf-8', 'replace')
+                ) is not None:
+                    offsets.append(pos)
+                pos += len(line)
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, item):
+        self.fdesc.seek(self.offsets[item])
+        return TargetFile._getaddr(
+            self.fdesc.readline().decode('utf-8', 'replace')
+        )
+
+
 class IterTargetFile(object):
     """The iterator object returned by `TargetFile.__iter__()`"""
 
@@ -378,9 +622,8 @@ class TargetZMapPreScan(TargetFile):
         self.infos['zmap_pre_scan'] = zmap_opts[:]
         zmap_opts = [zmap] + zmap_opts + ['-o', '-']
         self.tmpfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
-        for start, count in viewvalues(target.targets.ranges):
-            for net in utils.range2nets((start, start + count - 1)):
-                self.tmpfile.write("%s\n" % net)
+        for net in target.targets.iter_nets():
+            self.tmpfile.write("%s\n" % net)
         self.tmpfile.close()
         zmap_opts += ['-w', self.tmpfile.name]
         self.proc = subprocess.Popen(zmap_opts, stdout=subprocess.PIPE)
@@ -426,9 +669,8 @@ class TargetNmapPreScan(TargetZMapPreScan):
         # using a temporary file
         self.tmpfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
         nmap_opts = [nmap, '-iL', self.tmpfile.name, '-oG', '-'] + nmap_opts
-        for start, count in viewvalues(target.targets.ranges):
-            for net in utils.range2nets((start, start + count - 1)):
-                self.tmpfile.write("%s\n" % net)
+        for net in target.targets.iter_nets():
+            self.tmpfile.write("%s\n" % net)
         self.tmpfile.close()
         self.proc = subprocess.Popen(nmap_opts, stdout=subprocess.PIPE)
         self.targetsfd = self.proc.stdout
@@ -454,6 +696,13 @@ ARGPARSER.add_argument('--network', '-n', metavar='NET/MASK',
 ARGPARSER.add_argument('--routable', action="store_true")
 ARGPARSER.add_argument('--file', '-f', metavar='FILENAME',
                        help='read targets from a file')
+ARGPARSER.add_argument('--file-random', action='store_true',
+                       help='with --file, read targets in a random order '
+                       '(creates an index next to the file)')
+ARGPARSER.add_argument('--exclude-file', metavar='FILENAME', action='append',
+                       help='exclude the addresses, networks (NET/MASK) '
+                       'and ranges (START-STOP) listed in a file (can be '
+                       'used several times; not available with --file)')
 ARGPARSER.add_argument('--test', '-t', metavar='COUNT', type=int,
                        help='select COUNT addresses on local loop')
 ARGPARSER.add_argument('--zmap-prescan-port', type=int)
@@ -463,10 +712,36 @@ ARGPARSER.add_argument('--nmap-prescan-opts')
 ARGPARSER.add_argument('--limit', '-l', type=int,
                        help='number of addresses to output')
 ARGPARSER.add_argument('--state', type=int, nargs=4,
-                       help='internal LCG state')
+                       help='internal LCG state (with --shard, the state '
+                       'of the shard, to resume it)')
+ARGPARSER.add_argument('--shard', type=int, nargs=2, metavar=('K', 'N'),
+                       help='select the Kth (0 <= K < N) of N disjoint '
+                       'parts of the target (use the same --shard-seed '
+                       'to get the same parts)')
+ARGPARSER.add_argument('--shard-seed', type=int, default=0, metavar='SEED',
+                       help='with --shard, seed used to choose the order '
+                       'of the addresses dealt to the parts (defaults to 0)')
+
+
+def check_args(parser, args):
+    """Reports (using `parser.error()`) the combinations of target
+    arguments that cannot be used together.
+
+    """
+    if args.exclude_file and args.file is not None:
+        parser.error('argument --exclude-file: not allowed with argument '
+                     '--file')
+    if args.file_random and args.file is None:
+        parser.error('argument --file-random: requires argument --file')
+    if args.shard is not None and args.file is not None and \
+       not args.file_random:
+        parser.error('argument --shard: requires argument --file-random '
+                     'with argument --file')
 
 
 def target_from_args(args):
+    # with --shard, --state is the state of the shard (see below)
+    state = None if args.shard is not None else args.state
     if args.country is not None:
         countries = set()
         for country in args.country.split(','):
@@ -481,7 +756,7 @@ def target_from_args(args):
                 TargetCountry(country,
                               categories=args.categories,
                               maxnbr=args.limit,
-                              state=args.state)
+                              state=state)
                 for country in countries
             ),
         )
@@ -489,12 +764,12 @@ def target_from_args(args):
         target = TargetCity(args.city[0], args.city[1],
                             categories=args.categories,
                             maxnbr=args.limit,
-                            state=args.state)
+                            state=state)
     elif args.region is not None:
         target = TargetRegion(args.region[0], args.region[1],
                               categories=args.categories,
                               maxnbr=args.limit,
-                              state=args.state)
+                              state=state)
     elif args.asnum is not None:
         target = reduce(
             add,
@@ -502,7 +777,7 @@ def target_from_args(args):
                 TargetAS(asnum,
                          categories=args.categories,
                          maxnbr=args.limit,
-                         state=args.state)
+                         state=state)
                 for asnum in args.asnum.split(',')
             ),
         )
@@ -510,27 +785,36 @@ def target_from_args(args):
         target = TargetRange(args.range[0], args.range[1],
                              categories=args.categories,
                              maxnbr=args.limit,
-                             state=args.state)
+                             state=state)
     elif args.network is not None:
         target = TargetNetwork(args.network,
                                categories=args.categories,
                                maxnbr=args.limit,
-                               state=args.state)
+                               state=state)
     elif args.routable:
         target = TargetRoutable(categories=args.categories,
                                 maxnbr=args.limit,
-                                state=args.state)
+                                state=state)
     elif args.file is not None:
         target = TargetFile(args.file,
                             categories=args.categories,
-                            state=args.state)
+                            state=state,
+                            rand=args.file_random)
     elif args.test is not None:
         target = TargetTest(args.test,
                             categories=args.categories,
                             maxnbr=args.limit,
-                            state=args.state)
+                            state=state)
     else:
         return None
+    if args.exclude_file:
+        target = target.difference(*(TargetExcludeFile(fname)
+                                     for fname in args.exclude_file))
+    if args.shard is not None:
+        target = target.shard(*args.shard, seed=args.shard_seed)
+        if args.state is not None:
+            # resume the shard
+            target.state = args.state
     if args.zmap_prescan_port is not None:
         if args.zmap_prescan_opts is None:
             zmap_prescan_opts = []
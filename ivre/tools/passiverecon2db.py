@@ -20,8 +20,16 @@
 
 
 import functools
+import multiprocessing
+import os
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 import signal
+import stat
 import sys
+import threading
 
 
 import ivre.db
@@ -36,7 +44,9 @@ signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
 def _get_ignore_rules(ignore_spec):
     """Executes the ignore_spec file and returns the ignore_rules
-dictionary.
+dictionary, with the IGNORENETS and NEVERIGNORE rules compiled (see
+`ivre.passive.compile_ignorenets()` and
+`ivre.passive.compile_neverignore()`).
 
 Python 2.6 bug: it has to be in a separate function than main()
 because of the exec() call and the nested functions.
@@ -46,6 +56,12 @@ because of the exec() call and the nested functions.
     if ignore_spec is not None:
         exec(compile(open(ignore_spec, "rb").read(), ignore_spec, 'exec'),
              ignore_rules)
+    ignore_rules['IGNORENETS'] = ivre.passive.compile_ignorenets(
+        ignore_rules.get('IGNORENETS', {})
+    )
+    ignore_rules['NEVERIGNORE'] = ivre.passive.compile_neverignore(
+        ignore_rules.get('NEVERIGNORE', {})
+    )
     return ignore_rules
 
 
@@ -62,6 +78,91 @@ def rec_iter(bro_parser, sensor, ignore_rules):
         )
 
 
+# Number of lines sent at once to a worker process (--jobs); the
+# smaller CHUNK_SIZE_STREAM is used when the input is not a regular
+# file (e.g., a pipe fed by a running sensor), so that the records are
+# not held back until enough lines have been received
+CHUNK_SIZE = 10000
+CHUNK_SIZE_STREAM = 100
+
+# Set, in each worker process (--jobs), by _init_worker()
+WORKER_PARAMS = None
+
+
+def _init_worker(sensor, ignore_spec):
+    """Initializer for worker processes (--jobs). The ignore rules are
+    read by each worker, since they may not be picklable.
+
+    """
+    global WORKER_PARAMS
+    # SIGTERM is ignored by the main process, but is needed by
+    # Pool.terminate() to stop the workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    WORKER_PARAMS = (sensor, _get_ignore_rules(ignore_spec))
+
+
+def _parse_chunk(header_lines):
+    """Worker function: parses and normalizes a chunk of lines (see
+    `BroFile.iter_chunks()`), returns a list of (timestamp, spec)
+    tuples.
+
+    """
+    header, lines = header_lines
+    bro_parser = ivre.parser.bro.BroFile.from_header(header)
+    return list(rec_iter((bro_parser.parse_line(line) for line in lines),
+                         *WORKER_PARAMS))
+
+
+def rec_iter_parallel(bro_parser, sensor, ignore_spec, jobs,
+                      chunk_size=CHUNK_SIZE):
+    """Like `rec_iter()`, but the lines read by `bro_parser` are parsed
+    and normalized by `jobs` worker processes, in chunks of
+    `chunk_size` lines. The chunks are read (and sent to the workers)
+    by a separate thread, so that the records of a chunk are yielded
+    as soon as it has been parsed, even when no more input is
+    available yet. At most 2 * `jobs` chunks are read ahead, so that
+    the memory usage stays bounded when the database is slower than
+    the workers.
+
+    The records are written to the database by the caller, in the main
+    process and synchronously: the workers keep parsing the chunks
+    read ahead meanwhile, but only one batch of records is written at
+    a time.
+
+    """
+    pool = multiprocessing.Pool(processes=jobs, initializer=_init_worker,
+                                initargs=(sensor, ignore_spec))
+    # the AsyncResult objects, in order, then None (end of input) or
+    # the exception raised while reading the input
+    pending = Queue(maxsize=2 * jobs)
+
+    def _read_chunks():
+        try:
+            for chunk in bro_parser.iter_chunks(chunk_size):
+                pending.put(pool.apply_async(_parse_chunk, (chunk,)))
+        except Exception as exc:
+            pending.put(exc)
+        else:
+            pending.put(None)
+
+    reader = threading.Thread(target=_read_chunks)
+    # the thread may be blocked reading the input when we are done
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            result = pending.get()
+            if result is None:
+                break
+            if isinstance(result, Exception):
+                raise result
+            for rec in result.get():
+                yield rec
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def main():
     parser, _ = ivre.utils.create_argparser(__doc__)
     parser.add_argument('--sensor', '-s', help='Sensor name')
@@ -73,6 +174,9 @@ def main():
                         help='Use local (memory) bulk inserts')
     parser.add_argument('--no-bulk', action='store_true',
                         help='Do not use bulk inserts')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='Use N worker processes to parse and normalize '
+                        'the records')
     args = parser.parse_args()
     ignore_rules = _get_ignore_rules(args.ignore_spec)
     if (not (args.no_bulk or args.local_bulk)) or args.bulk:
@@ -90,7 +194,13 @@ def main():
     except AttributeError:
         stdin = sys.stdin
     bro_parser = ivre.parser.bro.BroFile(stdin)
-    function(
-        rec_iter(bro_parser, args.sensor, ignore_rules),
-        getinfos=ivre.passive.getinfos
-    )
+    if args.jobs > 1:
+        if stat.S_ISREG(os.fstat(stdin.fileno()).st_mode):
+            chunk_size = CHUNK_SIZE
+        else:
+            chunk_size = CHUNK_SIZE_STREAM
+        records = rec_iter_parallel(bro_parser, args.sensor, args.ignore_spec,
+                                    args.jobs, chunk_size=chunk_size)
+    else:
+        records = rec_iter(bro_parser, args.sensor, ignore_rules)
+    function(records, getinfos=ivre.passive.getinfos)
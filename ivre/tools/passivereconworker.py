@@ -19,11 +19,18 @@
 """Handle ivre passiverecon2db files."""
 
 
+import ctypes
+import ctypes.util
+import errno
+import heapq
 import os
 import re
+import select
 import shutil
 import signal
+import struct
 import subprocess
+import threading
 import time
 
 
@@ -35,6 +42,8 @@ FILEFORMAT = "^(?P<sensor>%s)\\.(?P<datetime>[0-9-]+)\\.log(?:\\.gz)?$"
 SLEEPTIME = 2
 CMDLINE = "%(progname)s -s %(sensor)s"
 WANTDOWN = False
+# Size of the data read from the files and written to the processes
+CHUNKSIZE = 1 << 20
 
 
 def shutdown(signum, _):
@@ -48,21 +57,163 @@ def shutdown(signum, _):
     WANTDOWN = True
 
 
-def getnextfiles(directory, sensor=None, count=1):
-    """Returns a list of maximum `count` filenames (as FILEFORMAT matches)
-    to process, given the `directory` and the `sensor` (or, if it is
-    `None`, from any sensor).
+def _sortkey(match):
+    return [int(val) for val in match.groupdict()['datetime'].split('-')]
+
+
+class FileQueue(object):
+    """The files (as FILEFORMAT matches) to process, sorted by date, for
+    each sensor. Files are added when they are found in the directory
+    (see `.update()`), so that the directory does not have to be
+    listed and sorted again each time a file is needed.
 
     """
-    if sensor is None:
-        fmt = re.compile(FILEFORMAT % "[^\\.]*")
-    else:
-        fmt = re.compile(FILEFORMAT % re.escape(sensor))
-    files = (fmt.match(f) for f in os.listdir(directory))
-    files = [f for f in files if f is not None]
-    files.sort(key=lambda x: [int(val) for val in
-                              x.groupdict()['datetime'].split('-')])
-    return files[:count]
+
+    def __init__(self, sensor=None):
+        if sensor is None:
+            self.fmt = re.compile(FILEFORMAT % "[^\\.]*")
+        else:
+            self.fmt = re.compile(FILEFORMAT % re.escape(sensor))
+        # {sensor: [(sortkey, filename, match), ...]} (heaps)
+        self.files = {}
+        self.known = set()
+
+    def update(self, fnames):
+        """Adds the files from `fnames` that match FILEFORMAT and are not
+        already in the queue.
+
+        """
+        for fname in fnames:
+            if fname in self.known:
+                continue
+            match = self.fmt.match(fname)
+            if match is None:
+                continue
+            self.known.add(fname)
+            heapq.heappush(
+                self.files.setdefault(match.groupdict()['sensor'], []),
+                (_sortkey(match), fname, match),
+            )
+
+    def sensors(self):
+        """Returns the sensors with files to process, the sensor with the
+        oldest file first.
+
+        """
+        return [sensor for _, sensor in
+                sorted((files[0][0], sensor)
+                       for sensor, files in self.files.items())]
+
+    def pop(self, sensor):
+        """Removes and returns the oldest file of `sensor`."""
+        _, fname, match = heapq.heappop(self.files[sensor])
+        if not self.files[sensor]:
+            del self.files[sensor]
+        self.known.discard(fname)
+        return match
+
+
+class PollWatcher(object):
+    """Finds the new files of a directory by listing it every
+    SLEEPTIME seconds.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.last = 0
+
+    def wait(self, timeout):
+        """Returns the names of the files found in the directory (or
+        None when the directory has not been listed), after at most
+        `timeout` seconds.
+
+        """
+        delay = self.last + SLEEPTIME - time.time()
+        if delay > timeout:
+            time.sleep(timeout)
+            return None
+        if delay > 0:
+            time.sleep(delay)
+        self.last = time.time()
+        return os.listdir(self.directory)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Finds the new files of a directory using Linux inotify (through
+    ctypes). Raises OSError (or AttributeError) when inotify is not
+    available.
+
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        self.directory = directory
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fdesc = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fdesc < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        if libc.inotify_add_watch(
+                self.fdesc, directory.encode(),
+                self.IN_CLOSE_WRITE | self.IN_MOVED_TO,
+        ) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fdesc)
+            raise OSError(err, 'inotify_add_watch() failed')
+
+    def wait(self, timeout):
+        """Returns the names of the files written or moved to the
+        directory (or None when no event occurred), after at most
+        `timeout` seconds. When events have been lost, the directory is
+        listed.
+
+        """
+        if not select.select([self.fdesc], [], [], timeout)[0]:
+            return None
+        try:
+            data = os.read(self.fdesc, 65536)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return None
+            raise
+        fnames = []
+        pos = 0
+        while pos < len(data):
+            _, mask, _, length = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            if mask & self.IN_Q_OVERFLOW:
+                utils.LOGGER.warning("inotify events lost, listing %r",
+                                     self.directory)
+                return os.listdir(self.directory)
+            fnames.append(
+                data[pos:pos + length].rstrip(b'\0').decode('utf-8', 'replace')
+            )
+            pos += length
+        return fnames
+
+    def close(self):
+        os.close(self.fdesc)
+
+
+def get_watcher(directory, use_inotify=True):
+    """Returns an InotifyWatcher object when possible, a PollWatcher
+    object otherwise.
+
+    """
+    if use_inotify:
+        try:
+            return InotifyWatcher(directory)
+        except (AttributeError, OSError, TypeError):
+            utils.LOGGER.info("Cannot use inotify, polling %r every %d s",
+                              directory, SLEEPTIME, exc_info=True)
+    return PollWatcher(directory)
 
 
 def create_process(progname, sensor):
@@ -79,62 +230,114 @@ def create_process(progname, sensor):
     )
 
 
-def worker(progname, directory, sensor=None):
+def _read_chunks(fdesc):
+    """Yields the data read from `fdesc` by chunks of (at least)
+    CHUNKSIZE bytes, made of complete lines, so that a chunk can be
+    written again, as a whole, to a new process.
+
+    """
+    while True:
+        data = fdesc.read(CHUNKSIZE)
+        if not data:
+            return
+        if not data.endswith(b'\n'):
+            data += fdesc.readline()
+        yield data
+
+
+def handle_file(progname, procs, sensor, fname):
+    """Feeds the process of `sensor` (from `procs`, created if needed)
+    with the data of `fname`, by chunks of complete lines (see
+    `_read_chunks()`), and removes the file when it has been handled.
+
+    """
+    if config.DEBUG:
+        utils.LOGGER.debug("Handling %s", fname)
+    if sensor not in procs:
+        procs[sensor] = create_process(progname, sensor)
+    fdesc = utils.open_file(fname)
+    handled_ok = True
+    for data in _read_chunks(fdesc):
+        try:
+            procs[sensor].stdin.write(data)
+        except (ValueError, IOError, OSError):
+            utils.LOGGER.warning("Error while handling data from %r. "
+                                 "Trying again", fname)
+            procs[sensor] = create_process(progname, sensor)
+            # Second (and last) try
+            try:
+                procs[sensor].stdin.write(data)
+                utils.LOGGER.warning("  ... OK")
+            except (ValueError, IOError, OSError):
+                handled_ok = False
+                utils.LOGGER.warning("  ... KO")
+    fdesc.close()
+    try:
+        procs[sensor].stdin.flush()
+    except (ValueError, IOError, OSError):
+        handled_ok = False
+    if handled_ok:
+        os.unlink(fname)
+        utils.LOGGER.debug('  ... OK')
+    else:
+        utils.LOGGER.debug('  ... KO')
+
+
+def worker(progname, directory, sensor=None, jobs=1, use_inotify=True):
     """This function is the main loop, creating the processes when
     needed and feeding them with the data from the files.
 
+    The files of up to `jobs` different sensors are handled at the
+    same time (each by a thread, feeding the process of the sensor);
+    the files of a given sensor are handled one at a time, in order.
+
     """
     utils.makedirs(os.path.join(directory, "current"))
     procs = {}
+    running = {}  # sensor: thread
+    queue = FileQueue(sensor=sensor)
+    watcher = get_watcher(directory, use_inotify=use_inotify)
+    queue.update(os.listdir(directory))
     while not WANTDOWN:
-        # We get the next file to handle
-        fname = getnextfiles(directory, sensor=sensor, count=1)
-        # ... if we don't, we sleep for a while
-        if not fname:
-            utils.LOGGER.debug("Sleeping for %d s", SLEEPTIME)
-            time.sleep(SLEEPTIME)
-            continue
-        fname = fname[0]
-        fname_sensor = fname.groupdict()['sensor']
-        if fname_sensor in procs:
-            proc = procs[fname_sensor]
-        else:
-            proc = create_process(progname, fname_sensor)
-            procs[fname_sensor] = proc
-        fname = fname.group()
-        # Our "lock system": if we can move the file, it's ours
-        try:
-            shutil.move(os.path.join(directory, fname),
-                        os.path.join(directory, "current"))
-        except shutil.Error:
-            continue
-        if config.DEBUG:
-            utils.LOGGER.debug("Handling %s", fname)
-        fname = os.path.join(directory, "current", fname)
-        fdesc = utils.open_file(fname)
-        handled_ok = True
-        for line in fdesc:
+        for fname_sensor, thread in list(running.items()):
+            if not thread.is_alive():
+                thread.join()
+                del running[fname_sensor]
+        for fname_sensor in queue.sensors():
+            if len(running) >= jobs:
+                break
+            if fname_sensor in running:
+                continue
+            fname = queue.pop(fname_sensor).group()
+            # Our "lock system": if we can move the file, it's ours
             try:
-                proc.stdin.write(line)
-            except ValueError:
-                utils.LOGGER.warning("Error while handling line %r. "
-                                     "Trying again", line)
-                proc = create_process(progname, fname_sensor)
-                procs[fname_sensor] = proc
-                # Second (and last) try
-                try:
-                    proc.stdin.write(line)
-                    utils.LOGGER.warning("  ... OK")
-                except ValueError:
-                    handled_ok = False
-                    utils.LOGGER.warning("  ... KO")
-        fdesc.close()
-        if handled_ok:
-            os.unlink(fname)
-            utils.LOGGER.debug('  ... OK')
+                shutil.move(os.path.join(directory, fname),
+                            os.path.join(directory, "current"))
+            except (shutil.Error, IOError, OSError):
+                continue
+            thread = threading.Thread(
+                target=handle_file,
+                args=(progname, procs, fname_sensor,
+                      os.path.join(directory, "current", fname)),
+            )
+            thread.start()
+            running[fname_sensor] = thread
+        if len(running) < jobs and any(fname_sensor not in running
+                                       for fname_sensor in queue.sensors()):
+            timeout = 0
+        elif running:
+            # check the threads regularly
+            timeout = 0.1
         else:
-            utils.LOGGER.debug('  ... KO')
+            utils.LOGGER.debug("Sleeping for %d s", SLEEPTIME)
+            timeout = SLEEPTIME
+        fnames = watcher.wait(timeout)
+        if fnames is not None:
+            queue.update(fnames)
     # SHUTDOWN
+    for thread in running.values():
+        thread.join()
+    watcher.close()
     for sensorjob in procs:
         procs[sensorjob].stdin.close()
         procs[sensorjob].wait()
@@ -161,6 +364,16 @@ def main():
         help='Program to run (defaults to ivre passiverecon2db).',
         default="ivre passiverecon2db",
     )
+    parser.add_argument(
+        '--jobs', '-j', metavar='N', type=int, default=1,
+        help='handle the files of up to N sensors at the same time '
+        '(defaults to 1).',
+    )
+    parser.add_argument(
+        '--poll', action='store_true',
+        help='list the directory every %d s instead of using inotify.' %
+        SLEEPTIME,
+    )
     args = parser.parse_args()
     if args.sensor is not None:
         SENSORS.update(dict([args.sensor.split(':', 1)
@@ -169,4 +382,5 @@ def main():
         sensor = args.sensor.split(':', 1)[0]
     else:
         sensor = None
-    worker(args.progname, args.directory, sensor=sensor)
+    worker(args.progname, args.directory, sensor=sensor, jobs=args.jobs,
+           use_inotify=not args.poll)
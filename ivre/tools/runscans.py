@@ -348,6 +348,7 @@ def main():
     if args.output == 'Agent':
         sys.stdout.write(ivre.agent.build_agent(template=args.nmap_template))
         sys.exit(0)
+    ivre.target.check_args(parser, args)
     targets = ivre.target.target_from_args(args)
     if args.output in ['Count', 'List', 'ListAll', 'ListCIDRs']:
         if isinstance(targets, ivre.target.TargetFile):
@@ -106,6 +106,7 @@ def main():
                 sys.exit(0)
             # we run the sync process in another screen window
             subprocess.call(['screen'] + argv + ['--sync'])
+        ivre.target.check_args(parser, args)
         targets = ivre.target.target_from_args(args)
         if targets is None:
             parser.error(
@@ -208,6 +208,7 @@ def main():
     if args.unassign is not None:
         ivre.db.db.agent.unassign_agent(ivre.db.db.agent.str2id(args.unassign))
 
+    ivre.target.check_args(parser, args)
     targets = ivre.target.target_from_args(args)
     if targets is not None:
         ivre.db.db.agent.add_scan(
@@ -21,6 +21,7 @@
 
 
 from __future__ import print_function
+import multiprocessing
 import os
 
 
@@ -40,6 +41,88 @@ def recursive_filelisting(base_directories):
                 yield os.path.join(root, leaffile)
 
 
+# Set, in each worker process (--jobs), by _init_worker()
+WORKER_DATABASE = None
+WORKER_PARAMS = None
+
+
+def _update_view_callback(host):
+    return ivre.db.db.view.store_or_merge_host(nmap_record_to_view(host))
+
+
+def _init_worker(params):
+    """Initializer for worker processes (--jobs). Each worker gets its
+    own database connections, since those cannot be shared between
+    processes.
+
+    """
+    global WORKER_DATABASE, WORKER_PARAMS
+    ivre.db.db = ivre.db.MetaDB(url=ivre.db.db.url, urls=ivre.db.db.urls)
+    WORKER_DATABASE = ivre.db.db.nmap
+    WORKER_PARAMS = dict(params)
+    if WORKER_PARAMS.pop('update_view'):
+        WORKER_PARAMS['callback'] = _update_view_callback
+
+
+def _hash_scan(scan):
+    """Worker function: returns the scan file and its hash."""
+    try:
+        return scan, ivre.utils.hash_file(scan, hashtype="sha256")
+    except Exception:
+        ivre.utils.LOGGER.warning("Exception (file %r)", scan, exc_info=True)
+        return scan, None
+
+
+def _store_scan(scan_filehash):
+    """Worker function: parses and stores a scan file, returns True when
+    the scan has been imported.
+
+    """
+    scan, filehash = scan_filehash
+    try:
+        return WORKER_DATABASE.store_scan(scan, filehash=filehash,
+                                          **WORKER_PARAMS)
+    except Exception:
+        ivre.utils.LOGGER.warning("Exception (file %r)", scan, exc_info=True)
+    return False
+
+
+def store_scans_parallel(scans, jobs, params):
+    """Imports `scans` using `jobs` worker processes. Files are hashed
+    first (in parallel), so that files with the same content given
+    more than once are only imported once, then parsed and stored (in
+    parallel). Each worker stores the hosts using its own database
+    connection, so this requires a backend that supports concurrent
+    writes (see `DB.concurrent_writes`).
+
+    Returns the number of imported scan files.
+
+    """
+    pool = multiprocessing.Pool(processes=jobs, initializer=_init_worker,
+                                initargs=(params,))
+    try:
+        seen = set()
+        tostore = []
+        for scan, filehash in pool.imap(_hash_scan, scans, chunksize=1):
+            if filehash is None:
+                continue
+            if filehash in seen:
+                ivre.utils.LOGGER.debug(
+                    "Scan already present in Database (%r).", scan
+                )
+                continue
+            seen.add(filehash)
+            tostore.append((scan, filehash))
+        count = sum(
+            1 for res in pool.imap_unordered(_store_scan, tostore, chunksize=1)
+            if res
+        )
+    finally:
+        pool.close()
+        pool.join()
+    return count
+
+
 def main():
     parser, use_argparse = ivre.utils.create_argparser(__doc__,
                                                        extraargs='scan')
@@ -71,6 +154,11 @@ def main():
                         help='Merge hosts in current view')
     parser.add_argument('--no-update-view', action='store_true',
                         help='Do not merge hosts in current view (default)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='Use N worker processes to parse and store scan'
+                        ' results (not available in test modes, nor with '
+                        'backends that do not support concurrent writes, '
+                        'such as TinyDB).')
     args = parser.parse_args()
     database = ivre.db.db.nmap
     categories = args.categories.split(',') if args.categories else []
@@ -86,13 +174,29 @@ def main():
         scans = recursive_filelisting(args.scan)
     else:
         scans = args.scan
-    if not args.update_view or args.no_update_view:
-        callback = None
+    update_view = args.update_view and not args.no_update_view
+    if args.jobs > 1 and not (args.test or args.test_normal):
+        if not database.concurrent_writes or (
+                update_view and not ivre.db.db.view.concurrent_writes
+        ):
+            parser.error('--jobs cannot be used with this database '
+                         'backend (no concurrent writes)')
+        count = store_scans_parallel(
+            scans, args.jobs,
+            {
+                'categories': categories, 'source': args.source,
+                'needports': args.ports, 'needopenports': args.open_ports,
+                'force_info': args.force_info,
+                'masscan_probes': args.masscan_probes,
+                'update_view': update_view,
+            },
+        )
+        ivre.utils.LOGGER.info("%d results imported.", count)
+        return
+    if update_view:
+        callback = _update_view_callback
     else:
-        def callback(x):
-            return ivre.db.db.view.store_or_merge_host(
-                nmap_record_to_view(x)
-            )
+        callback = None
     count = 0
     for scan in scans:
         try:
@@ -25,6 +25,7 @@ sub-module or script.
 
 
 import ast
+from array import array
 try:
     import argparse
     USE_ARGPARSE = True
@@ -34,11 +35,22 @@ except ImportError:
 from bisect import bisect_left
 import bz2
 import codecs
+try:
+    from collections import OrderedDict
+except ImportError:
+    # fallback to dict for Python 2.6; .popitem() accepts (and
+    # ignores) the `last` argument, so that it can be used as an LRU
+    # cache, that then evicts arbitrary entries rather than the oldest
+    # ones
+    class OrderedDict(dict):
+        def popitem(self, last=True):
+            return dict.popitem(self)
 import datetime
 import errno
 import functools
 import gzip
 import hashlib
+import heapq
 import json
 from io import BytesIO
 import logging
@@ -47,6 +59,10 @@ import os
 import re
 import shutil
 import socket
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 import struct
 import subprocess
 import time
@@ -89,6 +105,24 @@ REGEXP_T = type(re.compile(''))
 HEX = re.compile('^[a-f0-9]+$', re.IGNORECASE)
 
 
+def _array_uint64_typecode():
+    """Returns the `array` typecode for unsigned 64-bit integers, or None
+when none is available ('Q' does not exist before Python 3.3, 'L' is
+64-bit on most 64-bit Unix platforms).
+
+    """
+    for typecode in ['Q', 'L']:
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+
+ARRAY_UINT64 = _array_uint64_typecode()
+
+
 # IP address regexp, based on
 # https://gist.github.com/dfee/6ed3a4b05cfe7a6faf40a2102408d5d8
 
@@ -577,6 +611,19 @@ def cleandir(dirname):
             raise
 
 
+def is_newer(path, ref_path):
+    """Returns True when `path` exists and is not older than
+    `ref_path`. Files with the same modification time are considered
+    up to date, since on file systems with a one-second resolution, a
+    file built from another is often modified in the same second.
+
+    """
+    try:
+        return os.path.getmtime(path) >= os.path.getmtime(ref_path)
+    except OSError:
+        return False
+
+
 def isfinal(elt):
     """Decides whether or not elt is a final element (i.e., an element
     that does not contain other elements)
@@ -1222,20 +1269,152 @@ def get_nmap_svc_fp(proto="tcp", probe="NULL"):
     return _NMAP_PROBES[proto][probe]
 
 
+# The characters of some categories (\d, \s, \w) for bytes patterns
+_REGEXP_CATEGORIES = {
+    sre_parse.CATEGORY_DIGIT: set(range(ord('0'), ord('9') + 1)),
+    sre_parse.CATEGORY_SPACE: set(ord(char) for char in ' \t\n\r\f\v'),
+    sre_parse.CATEGORY_WORD: set(
+        ord(char) for char in
+        '_0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    ),
+}
+
+
+def _regexp_first_chars(subpattern, ignorecase):
+    """Returns the set of the characters (as integers) a string matched
+    by `subpattern` (a parsed regular expression, or a part of it) can
+    start with, or None when it cannot be determined (or when the empty
+    string may match).
+
+    """
+    for opcode, arg in subpattern:
+        if opcode is sre_parse.LITERAL:
+            chars = set([arg])
+        elif opcode is sre_parse.IN:
+            chars = set()
+            for itemop, itemarg in arg:
+                if itemop is sre_parse.LITERAL:
+                    chars.add(itemarg)
+                elif itemop is sre_parse.RANGE:
+                    chars.update(range(itemarg[0], itemarg[1] + 1))
+                elif itemop is sre_parse.CATEGORY and \
+                        itemarg in _REGEXP_CATEGORIES:
+                    chars.update(_REGEXP_CATEGORIES[itemarg])
+                else:
+                    # NEGATE, other categories, ...
+                    return None
+        elif opcode is sre_parse.SUBPATTERN:
+            # (group, add_flags, del_flags, pattern) or (group,
+            # pattern) with Python 2
+            if len(arg) == 4 and (arg[1] or arg[2]):
+                return None
+            return _regexp_first_chars(arg[-1], ignorecase)
+        elif opcode is sre_parse.BRANCH:
+            chars = set()
+            for branch in arg[1]:
+                branchchars = _regexp_first_chars(branch, ignorecase)
+                if branchchars is None:
+                    return None
+                chars.update(branchchars)
+            return chars
+        elif opcode in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            if not arg[0]:
+                return None
+            return _regexp_first_chars(arg[2], ignorecase)
+        else:
+            return None
+        if ignorecase:
+            chars.update([ord(chr(char).swapcase()) for char in chars
+                          if char < 128])
+        return chars
+    return None
+
+
+def _nmap_svc_fp_first_chars(regexp):
+    """Returns the set of the characters (as integers) a string must
+    start with to be matched by `regexp.search()`, or None when the
+    pattern is not anchored or when the set cannot be determined.
+
+    """
+    if regexp.flags & (re.MULTILINE | re.LOCALE | re.UNICODE):
+        return None
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except Exception:
+        return None
+    ignorecase = regexp.flags & re.IGNORECASE
+    if len(parsed) == 1 and parsed[0][0] is sre_parse.BRANCH:
+        # ^a|^b
+        branches = parsed[0][1][1]
+    else:
+        branches = [parsed]
+    chars = set()
+    for branch in branches:
+        branch = list(branch)
+        if not branch or branch[0][0] is not sre_parse.AT or \
+           branch[0][1] not in (sre_parse.AT_BEGINNING,
+                                sre_parse.AT_BEGINNING_STRING):
+            return None
+        branchchars = _regexp_first_chars(branch[1:], ignorecase)
+        if branchchars is None:
+            return None
+        chars.update(branchchars)
+    return chars
+
+
+def _nmap_svc_fp_index(fingerprints):
+    """Returns a tuple (index, others): `index` is a dict associating
+    each first byte (as a 1-byte bytes object) with the list, in the
+    original order, of the fingerprints that can match a value
+    starting with it; `others` is the list of the fingerprints that
+    can match a value starting with any other byte (or an empty
+    value).
+
+    Most Nmap patterns are anchored (^) and start with a literal (or a
+    class), so this reduces a lot the number of regular expressions to
+    try for each value.
+
+    """
+    index = {}
+    others = []
+    for i, (_, fingerprint) in enumerate(fingerprints):
+        chars = _nmap_svc_fp_first_chars(fingerprint['m'][0])
+        if chars is None:
+            others.append(i)
+            continue
+        for char in chars:
+            index.setdefault(char, []).append(i)
+    return (
+        dict(
+            (bytes(bytearray([char])),
+             [fingerprints[i] for i in heapq.merge(indexes, others)])
+            for char, indexes in viewitems(index)
+        ),
+        [fingerprints[i] for i in others],
+    )
+
+
 def match_nmap_svc_fp(output, proto="tcp", probe="NULL", soft=False):
     """Take output from a given probe and return the closest nmap
-    fingerprint."""
+    fingerprint.
+
+    Only the fingerprints that can match a value starting with the
+    first byte of `output` are tried (see `_nmap_svc_fp_index()`), in
+    the order of the Nmap file."""
     softmatch = {}
     result = {}
     try:
-        fingerprints = get_nmap_svc_fp(
+        fpinfos = get_nmap_svc_fp(
             proto=proto,
             probe=probe,
-        )['fp']
+        )
     except KeyError:
         pass
     else:
-        for service, fingerprint in fingerprints:
+        if 'index' not in fpinfos:
+            fpinfos['index'] = _nmap_svc_fp_index(fpinfos['fp'])
+        index, others = fpinfos['index']
+        for service, fingerprint in index.get(output[:1], others):
             match = fingerprint['m'][0].search(output)
             if match is not None:
                 if probe == 'NULL' and service == 'landesk-rc':
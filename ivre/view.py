@@ -339,11 +339,8 @@ def from_passive(flt, category=None):
             cur_rec = rec
         elif cur_addr != rec['addr']:
             # TODO: add_addr_info should be optional
-            cur_rec['infos'] = {}
-            for func in [db.data.country_byip,
-                         db.data.as_byip,
-                         db.data.location_byip]:
-                cur_rec['infos'].update(func(cur_addr) or {})
+            cur_rec['infos'] = db.data.infos_byip(cur_addr,
+                                                  addr_type=False) or {}
             yield cur_rec
             cur_rec = rec
             cur_addr = rec['addr']
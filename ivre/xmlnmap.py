@@ -2482,12 +2482,9 @@ class Nmap2DB(NmapHandler):
         if self.categories:
             self._curhost['categories'] = self.categories[:]
         if self._add_addr_infos:
-            self._curhost['infos'] = {}
-            for func in [self._db.data.country_byip,
-                         self._db.data.as_byip,
-                         self._db.data.location_byip]:
-                self._curhost['infos'].update(func(self._curhost['addr']) or
-                                              {})
+            self._curhost['infos'] = self._db.data.infos_byip(
+                self._curhost['addr'], addr_type=False,
+            ) or {}
         if self.source:
             self._curhost['source'] = self.source
         # We are about to insert data based on this file, so we want
@@ -0,0 +1,563 @@
+#! /usr/bin/env python
+
+# This file is part of IVRE.
+# Copyright 2011 - 2020 Pierre LALET <pierre@droids-corp.org>
+#
+# IVRE is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# IVRE is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with IVRE. If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmarks for some performance-sensitive parts of IVRE.
+
+Run `python benchmarks.py` to run every benchmark, or `python
+benchmarks.py NAME [NAME ...]` to run only some of them (use --list
+to get the available names).
+
+Some benchmarks need the data files (`ivre ipdata --download`).
+
+"""
+
+
+from __future__ import print_function
+
+
+from collections import OrderedDict
+from itertools import islice
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import argparse
+except ImportError:
+    argparse = None
+
+
+import ivre.config
+import ivre.db
+import ivre.db.maxmind
+import ivre.geoiputils
+import ivre.parser.bro
+import ivre.passive
+import ivre.target
+import ivre.utils
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    """Decorator used to register a benchmark."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def maxrss():
+    """Returns the maximum resident set size of the current process,
+    in kB.
+
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def mmdb_files():
+    """Returns the paths to the available MaxMind database files."""
+    if ivre.config.GEOIP_PATH is None or \
+       not os.path.isdir(ivre.config.GEOIP_PATH):
+        return []
+    return sorted(os.path.join(ivre.config.GEOIP_PATH, fname)
+                  for fname in os.listdir(ivre.config.GEOIP_PATH)
+                  if fname.endswith('.mmdb'))
+
+
+def random_ipv4(count, seed=0):
+    rand = random.Random(seed)
+    return [rand.randrange(0x01000000, 0xe0000000) for _ in range(count)]
+
+
+class MaxMindFileRead(ivre.db.maxmind.MaxMindFile):
+    """MaxMindFile that reads the whole file in memory (as
+    MaxMindFile used to do), used as a reference.
+
+    """
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.path, 'rb') as fdesc:
+                self._data = fdesc.read()
+        return self._data
+
+
+MAXMIND_LOADERS = {
+    'read': MaxMindFileRead,
+    'mmap': ivre.db.maxmind.MaxMindFile,
+}
+
+
+def _maxmind_load_child(loader, path, count):
+    """Run in a child process: loads `path` with `loader`, performs
+    `count` lookups and prints the time needed and the max RSS.
+
+    """
+    start = time.time()
+    mmfile = MAXMIND_LOADERS[loader](path)
+    loaded = time.time()
+    for addr in random_ipv4(count):
+        mmfile.lookup(addr)
+    print(loaded - start, time.time() - loaded, maxrss())
+
+
+@benchmark
+def maxmind_load(count=10000):
+    """Startup time, lookup time and memory usage (RSS) of the MaxMind
+    database loaders.
+
+    """
+    for path in mmdb_files():
+        print("  %s (%d lookups)" % (os.path.basename(path), count))
+        for loader in sorted(MAXMIND_LOADERS):
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--child', 'maxmind_load',
+                 loader, path, str(count)]
+            ).split()
+            print("    %-6s startup %8.3fs lookups %8.3fs max RSS %8d kB" % (
+                loader, float(out[0]), float(out[1]), int(out[2]),
+            ))
+
+
+@benchmark
+def maxmind_records_cache(count=1000000):
+    """Random IPv4 lookups in the MaxMind databases, with and without
+    the decoded records cache.
+
+    """
+    addrs = random_ipv4(count)
+    for path in mmdb_files():
+        print("  %s (%d lookups)" % (os.path.basename(path), count))
+        for cache_size in [0, ivre.config.GEOIP_RECORDS_CACHE_SIZE]:
+            mmfile = ivre.db.maxmind.MaxMindFile(path)
+            mmfile.records_cache_size = cache_size
+            start = time.time()
+            for addr in addrs:
+                mmfile.lookup(addr)
+            elapsed = time.time() - start
+            print("    cache size %-8s %8.3fs (%d lookups/s)" % (
+                cache_size, elapsed, count / elapsed,
+            ))
+
+
+class IPRangesLinear(ivre.geoiputils.IPRanges):
+    """IPRanges with a linear-time __getitem__() (as IPRanges used to
+    have), used as a reference.
+
+    """
+
+    def __getitem__(self, item):
+        rangeindex = max(i for i, offset in enumerate(self.offsets)
+                         if offset <= item)
+        return self.starts[rangeindex] + item - self.offsets[rangeindex]
+
+
+@benchmark
+def target_iteration(count=1000000, linear_count=1000):
+    """Creation of targets and (random order) iteration over their
+    first addresses, compared with a linear-time access to the nth
+    address.
+
+    """
+    for name, target_cls in [('COUNTRY-US',
+                              lambda: ivre.target.TargetCountry('US')),
+                             ('ROUTABLE', ivre.target.TargetRoutable)]:
+        start = time.time()
+        try:
+            target = target_cls()
+        except IOError:
+            print("  %s: data files not found" % name)
+            continue
+        print("  %s (%d ranges, %d addresses): created in %.3fs" % (
+            name, len(target.targets.starts), target.targetscount,
+            time.time() - start,
+        ))
+        start = time.time()
+        for _ in islice(target, count):
+            pass
+        elapsed = time.time() - start
+        print("    bisect  %8.3fs (%d addresses/s)" % (
+            elapsed, count / elapsed,
+        ))
+        target.targets.__class__ = IPRangesLinear
+        start = time.time()
+        for _ in islice(target, linear_count):
+            pass
+        elapsed = time.time() - start
+        print("    linear  %8.3fs (%d addresses/s)" % (
+            elapsed, linear_count / elapsed,
+        ))
+
+
+# Banners seen on the Internet, as found in TCP_SERVER_BANNER records
+BANNERS = [
+    b'SSH-2.0-OpenSSH_7.4p1 Debian-10+deb9u7\r\n',
+    b'SSH-2.0-OpenSSH_7.4\r\n',
+    b'SSH-2.0-OpenSSH_8.2p1 Ubuntu-4ubuntu0.1\r\n',
+    b'SSH-2.0-dropbear_2014.63\r\n',
+    b'SSH-2.0-Cisco-1.25\r\n',
+    b'SSH-1.99-OpenSSH_4.3\r\n',
+    b'220 ProFTPD 1.3.5 Server (Debian) [::ffff:192.0.2.1]\r\n',
+    b'220 (vsFTPd 3.0.3)\r\n',
+    b'220-FileZilla Server 0.9.60 beta\r\n220-written by Tim Kosse '
+    b'(tim.kosse@filezilla-project.org)\r\n',
+    b'220 Microsoft FTP Service\r\n',
+    b'220 mail.example.com ESMTP Postfix (Debian/GNU)\r\n',
+    b'220 mail.example.com ESMTP Exim 4.92 Mon, 06 Apr 2020 10:00:00 '
+    b'+0200\r\n',
+    b'220 mx.example.com Microsoft ESMTP MAIL Service ready at Mon, 6 Apr '
+    b'2020 10:00:00 +0200\r\n',
+    b'* OK [CAPABILITY IMAP4rev1 LITERAL+ SASL-IR LOGIN-REFERRALS ID ENABLE '
+    b'IDLE STARTTLS AUTH=PLAIN] Dovecot (Debian) ready.\r\n',
+    b'+OK Dovecot (Debian) ready.\r\n',
+    b'J\x00\x00\x00\n5.5.5-10.3.22-MariaDB-0+deb10u1\x00',
+    b'N\x00\x00\x00\n5.7.29-0ubuntu0.18.04.1\x00',
+    b'RFB 003.008\n',
+    b'\x03\x00\x00\x13\x0e\xd0\x00\x00\x124\x00\x02\x0f\x08\x00'
+    b'\x02\x00\x00\x00',
+    b'-ERR unknown command\r\n',
+    b'HTTP/1.1 400 Bad Request\r\nServer: nginx\r\n',
+    b'\x15\x03\x01\x00\x02\x02(',
+    b'',
+]
+
+
+@benchmark
+def nmap_svc_fp(count=100):
+    """Matching of TCP server banners against the Nmap service
+    fingerprints (NULL probe), with and without the first byte
+    dispatch table.
+
+    """
+    try:
+        fpinfos = ivre.utils.get_nmap_svc_fp()
+    except KeyError:
+        print("  nmap-service-probes file not found")
+        return
+    ivre.utils.match_nmap_svc_fp(b'')
+    index = fpinfos['index']
+    print("  %d fingerprints, %d tried at most for a banner" % (
+        len(fpinfos['fp']),
+        max(len(fps) for fps in list(index[0].values()) + [index[1]]),
+    ))
+    for name, fpindex in [('dispatch', index),
+                          ('linear', ({}, fpinfos['fp']))]:
+        fpinfos['index'] = fpindex
+        start = time.time()
+        for _ in range(count):
+            for banner in BANNERS:
+                ivre.utils.match_nmap_svc_fp(banner)
+        elapsed = time.time() - start
+        print("    %-8s %8.3fs (%d banners/s)" % (
+            name, elapsed, count * len(BANNERS) / elapsed,
+        ))
+    fpinfos['index'] = index
+
+
+class BroFileLegacy(ivre.parser.bro.BroFile):
+    """BroFile that converts each value according to its type name (as
+    BroFile used to do), used as a reference.
+
+    """
+
+    def parse_line(self, line):
+        if line.startswith(b'#'):
+            self.parse_header_line(line)
+            return next(self)
+        res = {}
+        fields = line.split(self.sep)
+        for field, name, typ in zip(fields, self.fields, self.types):
+            name = name.replace(b".", b"_").decode()
+            res[name] = self.fix_value(field, typ)
+        return res
+
+
+BRO_LOGS = {
+    'conn': (
+        [b'ts', b'uid', b'id.orig_h', b'id.orig_p', b'id.resp_h',
+         b'id.resp_p', b'proto', b'service', b'duration', b'orig_bytes',
+         b'resp_bytes', b'conn_state', b'local_orig', b'local_resp',
+         b'missed_bytes', b'history', b'orig_pkts', b'orig_ip_bytes',
+         b'resp_pkts', b'resp_ip_bytes', b'tunnel_parents'],
+        [b'time', b'string', b'addr', b'port', b'addr', b'port', b'enum',
+         b'string', b'interval', b'count', b'count', b'string', b'bool',
+         b'bool', b'count', b'string', b'count', b'count', b'count',
+         b'count', b'set[string]'],
+        lambda rand, i: [
+            b'%d.%06d' % (1500000000 + i, rand.randrange(1000000)),
+            b'C%016x' % rand.getrandbits(64),
+            b'10.0.%d.%d' % (rand.randrange(256), rand.randrange(256)),
+            b'%d' % rand.randrange(1024, 65536),
+            b'192.0.2.%d' % rand.randrange(256),
+            rand.choice([b'22', b'53', b'80', b'443']),
+            rand.choice([b'tcp', b'udp']),
+            rand.choice([b'-', b'http', b'ssl', b'dns']),
+            b'%f' % rand.random(),
+            b'%d' % rand.randrange(100000), b'%d' % rand.randrange(100000),
+            rand.choice([b'SF', b'S0', b'REJ']), b'-', b'-', b'0',
+            b'ShADadFf', b'%d' % rand.randrange(100),
+            b'%d' % rand.randrange(10000), b'%d' % rand.randrange(100),
+            b'%d' % rand.randrange(10000), b'(empty)',
+        ],
+        ['ts', 'id_orig_h', 'id_resp_h', 'id_resp_p', 'proto'],
+    ),
+    'passiverecon': (
+        [b'ts', b'uid', b'host', b'srvport', b'recon_type', b'source',
+         b'value', b'targetval'],
+        [b'time', b'string', b'addr', b'port', b'enum', b'string',
+         b'string', b'string'],
+        lambda rand, i: [
+            b'%d.%06d' % (1500000000 + i, rand.randrange(1000000)),
+            b'C%016x' % rand.getrandbits(64),
+            b'10.0.%d.%d' % (rand.randrange(256), rand.randrange(256)),
+            rand.choice([b'22', b'-', b'80']),
+            b'PassiveRecon::HTTP_SERVER_HEADER', b'SERVER',
+            b'Apache/2.4.%d (Debian)' % rand.randrange(50), b'-',
+        ],
+        ['ts', 'host', 'recon_type', 'value'],
+    ),
+}
+
+
+@benchmark
+def bro_parser(count=200000):
+    """Parsing of (generated) conn.log and passiverecon.log files, with
+    the per-column converters (with and without a projection) and
+    with a per-value type check.
+
+    """
+    rand = random.Random(0)
+    for path, (fields, types, genline, columns) in BRO_LOGS.items():
+        with tempfile.NamedTemporaryFile(delete=False) as fdesc:
+            fdesc.write(b'#separator \\x09\n#set_separator\t,\n'
+                        b'#empty_field\t(empty)\n#unset_field\t-\n'
+                        b'#path\t%s\n#fields\t%s\n#types\t%s\n' % (
+                            path.encode(), b'\t'.join(fields),
+                            b'\t'.join(types),
+                        ))
+            for i in range(count):
+                fdesc.write(b'\t'.join(genline(rand, i)) + b'\n')
+        print("  %s.log (%d lines)" % (path, count))
+        for name, parser in [
+                ('legacy', BroFileLegacy),
+                ('compiled', ivre.parser.bro.BroFile),
+                ('project', lambda fname: ivre.parser.bro.BroFile(
+                    fname, columns=columns,
+                )),
+        ]:
+            start = time.time()
+            with parser(fdesc.name) as brof:
+                while brof.read_records(1000):
+                    pass
+            elapsed = time.time() - start
+            print("    %-8s %8.3fs (%d lines/s)" % (name, elapsed,
+                                                    count / elapsed))
+        os.unlink(fdesc.name)
+
+
+def _is_ignored_linear(spec, ignorenets, neverignore):
+    """Ignore rules check, as _prepare_rec() used to do it (linear
+    search, uncompiled rules), used as a reference.
+
+    """
+    if 'addr' in spec and \
+       spec.get('source') not in neverignore.get(spec['recontype'], []):
+        for start, stop in ignorenets.get(spec['recontype'], ()):
+            if start <= ivre.utils.force_ip2int(spec['addr']) <= stop:
+                return True
+    return False
+
+
+@benchmark
+def passive_ignore(count=100000, nranges=5000, linear_count=1000):
+    """Check of passive records against `nranges` ignore rules
+    (IGNORENETS), using the compiled rules (bisect) and a linear
+    search.
+
+    """
+    rand = random.Random(0)
+    ignorenets = {'HTTP_CLIENT_HEADER': []}
+    for _ in range(nranges):
+        start = rand.randint(0, 0xffffffff - 0xffff)
+        ignorenets['HTTP_CLIENT_HEADER'].append(
+            (start, start + rand.randint(0, 0xffff))
+        )
+    neverignore = {'HTTP_CLIENT_HEADER': ['HOST']}
+    specs = [{'recontype': 'HTTP_CLIENT_HEADER', 'source': 'USER-AGENT',
+              'value': 'Mozilla/5.0',
+              'addr': ivre.utils.int2ip(addr)}
+             for addr in random_ipv4(count)]
+    start = time.time()
+    compiled = (ivre.passive.compile_ignorenets(ignorenets),
+                ivre.passive.compile_neverignore(neverignore))
+    print("  %d ranges compiled to %d ranges in %.3fs" % (
+        nranges, len(compiled[0]['HTTP_CLIENT_HEADER'][0]),
+        time.time() - start,
+    ))
+    start = time.time()
+    ignored = 0
+    for spec in specs:
+        if ivre.passive._prepare_rec(dict(spec), *compiled) is None:
+            ignored += 1
+    elapsed = time.time() - start
+    print("    bisect  %8.3fs (%d records/s, %d ignored)" % (
+        elapsed, count / elapsed, ignored,
+    ))
+    start = time.time()
+    ignored = 0
+    for spec in specs[:linear_count]:
+        if _is_ignored_linear(spec, ignorenets, neverignore):
+            ignored += 1
+    elapsed = time.time() - start
+    print("    linear  %8.3fs (%d records/s, %d ignored)" % (
+        elapsed, linear_count / elapsed, ignored,
+    ))
+
+
+class SqliteDBPassiveLegacy(object):
+    """Mixin for SqliteDBPassive: per-record INSERT, then UPDATE on
+    conflict, in autocommit mode (as SqliteDBPassive used to do), used
+    as a reference.
+
+    """
+
+    def _insert_or_update(self, timestamp, values, lastseen=None):
+        from sqlalchemy import and_, func, insert, update
+        from sqlalchemy.exc import IntegrityError
+        passive = self.tables.passive
+        stmt = insert(passive).values(
+            dict(values, addr=ivre.utils.force_int2ip(values['addr']))
+        )
+        try:
+            self.db.execute(stmt)
+        except IntegrityError:
+            whereclause = and_(*(getattr(passive, key) == values[key]
+                                 for key in ['addr', 'sensor', 'recontype',
+                                             'source', 'value', 'targetval',
+                                             'info', 'port']))
+            self.db.execute(update(passive).where(whereclause).values({
+                'firstseen': func.least(passive.firstseen, timestamp),
+                'lastseen': func.greatest(passive.lastseen,
+                                          lastseen or timestamp),
+                'count': passive.count + values['count'],
+            }))
+
+    def insert_or_update_bulk(self, specs, getinfos=None,
+                              separated_timestamps=True):
+        return ivre.db.DBPassive.insert_or_update_bulk(
+            self, specs, getinfos=getinfos,
+            separated_timestamps=separated_timestamps,
+        )
+
+
+def passive_records(count, seed=0):
+    """Generates `count` (timestamp, spec) passive records, with about
+    one third of duplicates.
+
+    """
+    rand = random.Random(seed)
+    addrs = [ivre.utils.int2ip(addr) for addr in random_ipv4(1000, seed)]
+    for _ in range(count):
+        yield (1600000000 + rand.randrange(86400), {
+            'schema_version': ivre.passive.SCHEMA_VERSION,
+            'recontype': 'HTTP_CLIENT_HEADER', 'source': 'USER-AGENT',
+            'sensor': 'BENCH', 'addr': rand.choice(addrs),
+            'value': 'Mozilla/5.0 (%d)' % rand.randrange(count // 3 or 1),
+        })
+
+
+@benchmark
+def sqlite_passive(count=1000000, legacy_count=10000):
+    """Insertion of passive records in an SQLite database, using
+    `.insert_or_update_bulk()` (transactions, WAL journal, executemany()
+    upsert) compared with the per-record INSERT / UPDATE.
+
+    """
+    try:
+        import ivre.db.sql.sqlite
+    except ImportError:
+        print("  sqlalchemy not found")
+        return
+    try:
+        from urlparse import urlparse
+    except ImportError:
+        from urllib.parse import urlparse
+    tmpdir = tempfile.mkdtemp()
+    # A single instance must be created, since SqliteDBPassive()
+    # adds its indexes to the (shared) passive table.
+    db = ivre.db.sql.sqlite.SqliteDBPassive(
+        urlparse('sqlite:///%s' % os.path.join(tmpdir, 'passive.db'))
+    )
+    try:
+        for name, nrecs in [('bulk', count), ('legacy', legacy_count)]:
+            if name == 'legacy':
+                db.__class__ = type('SqliteDBPassiveLegacy',
+                                    (SqliteDBPassiveLegacy,
+                                     ivre.db.sql.sqlite.SqliteDBPassive),
+                                    {})
+            db.init()
+            start = time.time()
+            db.insert_or_update_bulk(passive_records(nrecs))
+            elapsed = time.time() - start
+            print("  %-6s %8.3fs (%d records/s, %d in database)" % (
+                name, elapsed, nrecs / elapsed,
+                db.count(db.flt_empty),
+            ))
+    finally:
+        for fname in os.listdir(tmpdir):
+            os.unlink(os.path.join(tmpdir, fname))
+        os.rmdir(tmpdir)
+
+
+CHILDREN = {
+    'maxmind_load': lambda loader, path, count: _maxmind_load_child(
+        loader, path, int(count)
+    ),
+}
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        CHILDREN[sys.argv[2]](*sys.argv[3:])
+        return
+    if argparse is None:
+        names = sys.argv[1:]
+    else:
+        parser = argparse.ArgumentParser(description=__doc__)
+        parser.add_argument('--list', action='store_true',
+                            help='List available benchmarks.')
+        parser.add_argument('names', nargs='*', metavar='NAME',
+                            help='Benchmarks to run (default: all).')
+        args = parser.parse_args()
+        if args.list:
+            for name, func in BENCHMARKS.items():
+                print("%s: %s" % (name, ' '.join(func.__doc__.split())))
+            return
+        names = args.names
+    for name in names or BENCHMARKS:
+        print("%s:" % name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -61,7 +61,9 @@ else:
 import ivre
 import ivre.config
 import ivre.db
+import ivre.db.maxmind
 import ivre.flow
+import ivre.geoiputils
 import ivre.mathutils
 import ivre.parser.bro
 import ivre.parser.iptables
@@ -123,7 +125,7 @@ def coverage_run_iter(cmd, stdin=None, stdout=subprocess.PIPE,
                     stdin=stdin, stdout=stdout, stderr=stderr)
 
 
-def run_passiverecon_worker(bulk_mode=None):
+def run_passiverecon_worker(bulk_mode=None, jobs=1):
     time.sleep(1)  # Hack for Travis CI
     pid = os.fork()
     if pid < 0:
@@ -144,14 +146,15 @@ def run_passiverecon_worker(bulk_mode=None):
                 "--progname", " ".join(
                     pipes.quote(elt) for elt in
                     COVERAGE + ["run", "--parallel-mode", which("ivre"),
-                                "passiverecon2db", bulk_mode]
+                                "passiverecon2db", bulk_mode, "--jobs",
+                                str(jobs)]
                 ),
             ],
         )
     else:
         os.execlp("ivre", "ivre", "passivereconworker", "--directory",
                   "logs", "--progname",
-                  "ivre passiverecon2db %s" % bulk_mode)
+                  "ivre passiverecon2db %s --jobs %d" % (bulk_mode, jobs))
 
 
 class AgentScanner(object):
@@ -848,6 +851,35 @@ purposes to feed Elasticsearch view.
         self.assertEqual(host_counter, host_counter_test)
         self.assertEqual(scan_counter, scan_warning)
 
+        # Parallel insertion (using worker processes), in a new
+        # database: the same hosts must be stored
+        nmap_files = {}
+        for fname in self.nmap_files:
+            nmap_files.setdefault(
+                fname.split('-probe-')[1] if "-probe-" in fname else None,
+                []
+            ).append(fname)
+        if ivre.db.db.nmap.concurrent_writes:
+            self.init_nmap_db()
+            host_counter_jobs = 0
+            for probe, fnames in nmap_files.items():
+                options = ["ivre", "scan2db", "--jobs", "2", "--port", "-c",
+                           "TEST", "-s", "SOURCE"]
+                if probe is not None:
+                    options.extend(["--masscan-probes", probe])
+                options.extend(["--"] + fnames)
+                res, _, err = RUN(options)
+                self.assertEqual(res, 0)
+                host_counter_jobs += sum(1 for _ in
+                                         host_stored.finditer(err))
+            self.assertEqual(host_counter_jobs, host_counter)
+            self.assertEqual(RUN(["ivre", "scancli", "--count"])[1],
+                             ("%d\n" % host_counter).encode())
+        else:
+            res, _, _ = RUN(["ivre", "scan2db", "--jobs", "2", "--port",
+                             "-c", "TEST", "-s", "SOURCE"] + self.nmap_files)
+            self.assertNotEqual(res, 0)
+
         hosts_count = self.check_nmap_count_value("nmap_get_count",
                                                   ivre.db.db.nmap.flt_empty,
                                                   [], None)
@@ -1597,7 +1629,10 @@ purposes to feed Elasticsearch view.
             bulk_mode = random.choice(['--bulk', '--local-bulk'])
         else:
             bulk_mode = random.choice(['--bulk', '--no-bulk', '--local-bulk'])
-        print('Running passive tests with %s' % bulk_mode)
+        jobs = random.choice([1, 2])
+        print('Running passive tests with %s (%d job%s)' % (
+            bulk_mode, jobs, 's' if jobs > 1 else '',
+        ))
 
         # Init DB
         self.assertEqual(RUN(["ivre", "ipinfo", "--count"])[1], b"0\n")
@@ -1628,7 +1663,7 @@ purposes to feed Elasticsearch view.
                 env=broenv)
             broprocess.wait()
 
-        run_passiverecon_worker(bulk_mode=bulk_mode)
+        run_passiverecon_worker(bulk_mode=bulk_mode, jobs=jobs)
 
         # Counting
         total_count = ivre.db.db.passive.count(
@@ -3042,6 +3077,21 @@ purposes to feed Elasticsearch view.
         self.assertEqual(res, 0)
         self.assertTrue(not out)
         self.check_flow_count_value("flow_count_cleanup", {}, [], None)
+        # Same thing, with the cleanup run separately
+        res, out, err = RUN(["ivre", "flowcli", "--init"],
+                            stdin=open(os.devnull))
+        self.assertEqual(res, 0)
+        self.assertTrue(not err)
+        res, out, err = RUN(['ivre', 'zeek2db', '--no-cleanup',
+                             os.path.join(os.getcwd(), "samples",
+                                          "mongo_conn.log")])
+        self.assertEqual(res, 0)
+        self.assertTrue(not out)
+        ivre.db.db.flow.cleanup_flows()
+        if DATABASE == "tinydb":
+            ivre.db.db.flow.invalidate_cache()
+            self.restart_web_server()
+        self.check_flow_count_value("flow_count_cleanup", {}, [], None)
 
         # Test netflow capture insertion
         res, out, err = RUN(["ivre", "flowcli", "--init"],
@@ -3114,6 +3164,53 @@ purposes to feed Elasticsearch view.
                         stdout=sys.stdout, stderr=sys.stderr)
         self.assertEqual(proc.wait(), 0)
 
+        # IPv4 ranges index vs tree lookups
+        ivre.db.db.data.reload_files()
+        for subdb in [ivre.db.db.data.db_asn, ivre.db.db.data.db_country,
+                      ivre.db.db.data.db_city]:
+            index = subdb.ranges_index
+            self.assertIsNotNone(index)
+            for addr in ['8.8.8.8', '1.1.1.1', '10.0.0.1', '2003::1']:
+                result = subdb.lookup(addr)
+                subdb.ranges_index = None
+                self.assertEqual(result, subdb.lookup(addr))
+                subdb.ranges_index = index
+        # the records read from an index are the same as those
+        # written, including values of type bytes
+        if ivre.db.maxmind.MaxMindRangesIndex.AVAILABLE:
+            records = [
+                {'name': 'first', 'raw': b'\x00\xff',
+                 'values': [1, 2.5, b'value', {'sub': b'\x01'}]},
+                {'name': 'second', 'size': 1 << 40},
+            ]
+            fdesc = tempfile.NamedTemporaryFile(delete=False)
+            ivre.db.maxmind.MaxMindRangesIndex.write(fdesc, [
+                (0, 0x7fffffff, records[0]),
+                (0x80000000, 0xffffffff, records[1]),
+            ])
+            fdesc.close()
+            index = ivre.db.maxmind.MaxMindRangesIndex(fdesc.name)
+            self.assertEqual(index.lookup_prefix(0x01020304),
+                             (97, records[0]))
+            self.assertEqual(index.lookup_prefix(0xfffffffe),
+                             (97, records[1]))
+            os.unlink(fdesc.name)
+
+        # Ranges indexes vs CSV dumps
+        for datafile, name, key in [
+                ('GeoLite2-Country.dump-IPv4.csv', 'country', 'PN'),
+                ('GeoLite2-ASN.dump-IPv4.csv', 'asnum', '15169'),
+                ('GeoLite2-City.dump-IPv4.csv', 'region', 'FR,NAQ'),
+        ]:
+            index = ivre.geoiputils.RangesIndex(datafile, name)
+            self.assertTrue(index.is_valid())
+            self.assertEqual(
+                list(index.get_ranges(key).iter_int_ranges()),
+                list(ivre.geoiputils.get_ranges_by_data(
+                    datafile, lambda line: index.keyfunc(line) == key,
+                ).iter_int_ranges()),
+            )
+
         res, out, _ = RUN(["ivre", "ipdata", "8.8.8.8"])
         self.assertEqual(res, 0)
         # The order may differ, depending on the backend.  We need to
@@ -3227,6 +3324,26 @@ purposes to feed Elasticsearch view.
                 json.loads(udesc.read().decode()),
             )
 
+        # Cached lookups (by network prefix) vs separate lookups
+        ivre.db.db.data.clear_infos_cache()
+        for addr in ['8.8.8.8', '8.8.8.9', '8.8.4.4', '8.8.8.8', '2003::1']:
+            result = {}
+            for func in [ivre.db.db.data.country_byip,
+                         ivre.db.db.data.as_byip,
+                         ivre.db.db.data.location_byip]:
+                result.update(func(addr) or {})
+            self.assertEqual(
+                ivre.db.db.data.infos_byip(addr, addr_type=False) or {},
+                result,
+            )
+        self.assertGreater(ivre.db.db.data.infos_cache_hits, 0)
+
+        # Batch lookups
+        addrs = ['8.8.8.8', '2003::1', '10.0.0.1', '8.8.4.4', '8.8.8.9',
+                 '1.1.1.1']
+        self.assertEqual(ivre.db.db.data.infos_byip_many(addrs),
+                         [ivre.db.db.data.infos_byip(addr) for addr in addrs])
+
         # targets manipulation
         targ1 = ivre.target.TargetCountry('PN')
         targ2 = ivre.target.TargetCountry('BV')
@@ -3502,6 +3619,110 @@ purposes to feed Elasticsearch view.
             self.assertTrue(is_prime(nbr) or len(factors) > 1)
             self.assertTrue(all(is_prime(x) for x in factors))
             self.assertEqual(reduce(lambda x, y: x * y, factors), nbr)
+        self.assertEqual(
+            ivre.mathutils.factorize(2 ** 128 - 1),
+            (3, 5, 17, 257, 641, 65537, 274177, 6700417, 67280421310721),
+        )
+        self.assertEqual(ivre.mathutils.factorize((2 ** 61 - 1) ** 2),
+                         (2 ** 61 - 1, 2 ** 61 - 1))
+        # With max_steps, factors may not be prime
+        nbr = (2 ** 89 - 1) * (2 ** 107 - 1) * 12
+        factors = ivre.mathutils.factorize(nbr, max_steps=1024)
+        self.assertEqual(factors[:3], (2, 2, 3))
+        self.assertEqual(reduce(lambda x, y: x * y, factors), nbr)
+        # IP ranges
+        ranges1 = ivre.geoiputils.IPRanges([(10, 19), (30, 34)])
+        ranges2 = ivre.geoiputils.IPRanges([(5, 11), (20, 20), (40, 41)])
+        ranges = ranges1.union(ranges2)
+        self.assertEqual(list(ranges.iter_int_ranges()),
+                         [(5, 20), (30, 34), (40, 41)])
+        self.assertEqual([ranges[i] for i in range(len(ranges))],
+                         list(range(5, 21)) + list(range(30, 35)) + [40, 41])
+        with self.assertRaises(IndexError):
+            ranges[len(ranges)]
+        self.assertEqual(
+            list(ranges.difference(
+                ivre.geoiputils.IPRanges([(0, 5), (11, 12)]),
+                ivre.geoiputils.IPRanges([(15, 31), (34, 40)]),
+            ).iter_int_ranges()),
+            [(6, 10), (13, 14), (32, 33), (41, 41)],
+        )
+        self.assertEqual(
+            list(ranges.intersection(
+                ivre.geoiputils.IPRanges([(0, 5), (11, 12), (15, 31)]),
+                ivre.geoiputils.IPRanges([(0, 11), (18, 50)]),
+            ).iter_int_ranges()),
+            [(5, 5), (11, 11), (18, 20), (30, 31)],
+        )
+        # Exclusion files
+        fdesc = tempfile.NamedTemporaryFile(delete=False, mode='w')
+        fdesc.write("# opt-out\n127.0.0.8/29\n127.0.0.2\n"
+                    "127.0.0.3 - 127.0.0.4 # range\n127.0.0.10\n")
+        fdesc.close()
+        target = ivre.target.TargetTest(count=100) - \
+            ivre.target.TargetExcludeFile(fdesc.name)
+        os.unlink(fdesc.name)
+        self.assertEqual(len(target), 100 - 11)
+        self.assertEqual(
+            sorted(target),
+            [0x7f000001] + list(range(0x7f000005, 0x7f000008)) +
+            list(range(0x7f000010, 0x7f000065)),
+        )
+        # Random order targets from a file
+        fdesc = tempfile.NamedTemporaryFile(delete=False)
+        fdesc.write(b"# comment\n")
+        fdesc.writelines(("10.0.%d.%d # addr\n" % divmod(i, 256)).encode()
+                         for i in range(1000))
+        fdesc.close()
+        target = ivre.target.TargetFile(fdesc.name, rand=True)
+        self.assertTrue(os.path.isfile(fdesc.name + '.ivre-offsets'))
+        self.assertEqual(len(target), 1000)
+        addrs = list(target)
+        self.assertNotEqual(addrs, sorted(addrs))
+        self.assertEqual(sorted(addrs), list(range(0x0a000000, 0x0a0003e8)))
+        os.unlink(fdesc.name)
+        os.unlink(fdesc.name + '.ivre-offsets')
+        # Target shards
+        target = ivre.target.TargetTest(count=1000)
+        shards = [target.shard(k, 3) for k in range(3)]
+        addrs = list(target)
+        self.assertEqual([len(shard) for shard in shards], [334, 333, 333])
+        for k, shard in enumerate(shards):
+            self.assertEqual(list(shard), addrs[k::3])
+        # ... built in separate processes, they are disjoint
+        addrs = []
+        for k in range(3):
+            res, out, _ = RUN(["ivre", "runscans", "--output", "ListAllRand",
+                               "--test", "100", "--shard", str(k), "3"])
+            self.assertEqual(res, 0)
+            addrs.extend(out.split())
+        self.assertEqual(len(addrs), 100)
+        self.assertEqual(len(set(addrs)), 100)
+        # ... and can be resumed, using their own state
+        target = ivre.target.TargetTest(count=100).shard(1, 3)
+        targiter = iter(target)
+        addrs = [ivre.utils.int2ip(next(targiter)).encode()
+                 for _ in range(10)]
+        res, out, _ = RUN(["ivre", "runscans", "--output", "ListAllRand",
+                           "--test", "100", "--shard", "1", "3", "--state"] +
+                          [str(val) for val in targiter.getstate()])
+        self.assertEqual(res, 0)
+        self.assertEqual(len(out.split()), 23)
+        self.assertEqual(addrs + out.split(),
+                         [ivre.utils.int2ip(addr).encode()
+                          for addr in target])
+        # is_newer()
+        tmpdir = tempfile.mkdtemp()
+        src, dst = (os.path.join(tmpdir, fname) for fname in ['src', 'dst'])
+        self.assertFalse(ivre.utils.is_newer(dst, src))
+        for fname in [src, dst]:
+            open(fname, 'w').close()
+        os.utime(src, (1000000000, 1000000000))
+        os.utime(dst, (1000000000, 1000000000))
+        self.assertTrue(ivre.utils.is_newer(dst, src))
+        os.utime(src, (1000000001, 1000000001))
+        self.assertFalse(ivre.utils.is_newer(dst, src))
+        shutil.rmtree(tmpdir)
         # Readables
         self.assertEqual(ivre.utils.num2readable(1000), '1k')
         self.assertEqual(
@@ -3694,6 +3915,71 @@ purposes to feed Elasticsearch view.
                 result
             )
 
+        # getinfos() cache
+        ivre.passive.getinfos_cache_clear()
+        spec = {'recontype': 'HTTP_CLIENT_HEADER', 'source': 'AUTHORIZATION',
+                'value': 'Basic dXNlcjpwYXNzd29yZA=='}
+        infos = ivre.passive.getinfos(dict(spec))
+        self.assertEqual(infos, {'infos': {'username': 'user',
+                                           'password': 'password'}})
+        infos['infos']['username'] = 'modified'
+        self.assertEqual(ivre.passive.getinfos(dict(spec)),
+                         {'infos': {'username': 'user',
+                                    'password': 'password'}})
+        stats = ivre.passive.getinfos_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        # certificates (SSL_SERVER records) are cached too
+        ivre.passive.getinfos_cache_clear()
+        spec = {'recontype': 'SSL_SERVER', 'source': 'cert', 'value': (
+            'MIIBfDCCASOgAwIBAgIUfK1HU4gDWkoKoqRI+Ek7xXoEmcIwCgYIKoZIzj0EAwIw'
+            'FDESMBAGA1UEAwwJaXZyZS50ZXN0MB4XDTI2MTAxNjIyNDMyOVoXDTM2MTAxMzIy'
+            'NDMyOVowFDESMBAGA1UEAwwJaXZyZS50ZXN0MFkwEwYHKoZIzj0CAQYIKoZIzj0D'
+            'AQcDQgAEbrHNifTGcIatxYXThwbysetjJ/cZ0BzXbGsXQR70hHwqZH1KWGtgGhGR'
+            '0DJbFhFqL2Yu/HSZhb4vvbe1Nb/wP6NTMFEwHQYDVR0OBBYEFI16i9dEMSOPwDh2'
+            'lxKTIkQjscwGMB8GA1UdIwQYMBaAFI16i9dEMSOPwDh2lxKTIkQjscwGMA8GA1Ud'
+            'EwEB/wQFMAMBAf8wCgYIKoZIzj0EAwIDRwAwRAIgVxwBHNSMo0kB5YVgbKFDEErZ'
+            'jNY1XA2NCFbyerX7FXkCIBXMXqt3fqMRFct8trcp3PDivzSNlyNER/+rWqmp/zPc'
+        )}
+        infos = ivre.passive.getinfos(dict(spec))
+        self.assertEqual(infos['infos']['sha256'],
+                         'c8fcd51716be55f4b76a818f778b4e0c'
+                         'db450ad6ec55a570d0f8eff8e3da78bb')
+        self.assertEqual(infos['infos']['subject_text'],
+                         'commonName=ivre.test')
+        self.assertEqual(ivre.passive.getinfos(dict(spec)), infos)
+        stats = ivre.passive.getinfos_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # Passive ignore rules
+        ignorenets = ivre.passive.compile_ignorenets({
+            'HTTP_CLIENT_HEADER': [('10.0.0.0', '10.0.0.255'),
+                                   ('10.0.1.0', '10.0.1.127'),
+                                   (ivre.utils.ip2int('10.0.0.128'),
+                                    ivre.utils.ip2int('10.0.0.200')),
+                                   ('192.168.0.10', '192.168.0.1')],
+        })
+        self.assertEqual(ignorenets, {'HTTP_CLIENT_HEADER': (
+            [ivre.utils.ip2int('10.0.0.0')],
+            [ivre.utils.ip2int('10.0.1.127')],
+        )})
+        neverignore = ivre.passive.compile_neverignore({
+            'HTTP_CLIENT_HEADER': ['HOST'],
+        })
+        for addr, source, ignored in [('9.255.255.255', 'USER-AGENT', False),
+                                      ('10.0.0.0', 'USER-AGENT', True),
+                                      ('10.0.1.127', 'USER-AGENT', True),
+                                      ('10.0.1.128', 'USER-AGENT', False),
+                                      ('192.168.0.5', 'USER-AGENT', False),
+                                      ('10.0.0.1', 'HOST', False)]:
+            spec = {'recontype': 'HTTP_CLIENT_HEADER', 'source': source,
+                    'value': 'value', 'addr': addr}
+            self.assertEqual(
+                ivre.passive._prepare_rec(spec, ignorenets,
+                                          neverignore) is None,
+                ignored,
+            )
+
         # DNS audit domain
         with tempfile.NamedTemporaryFile(delete=False) as fdesc:
             res = RUN(["ivre", "auditdom", "ivre.rocks", "zonetransfer.me"],